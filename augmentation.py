@@ -8,17 +8,23 @@ import random
 import numpy as np
 import PIL
 
-from skimage.transform import resize, rotate
+from skimage.color import rgb2hsv, hsv2rgb
+import torch
+import torch.nn.functional as F
 import torchvision
 
-import warnings
 
-from skimage import img_as_ubyte, img_as_float
+def clip_to_tensor(clip):
+    return torch.from_numpy(np.ascontiguousarray(clip, dtype=np.float32)).permute(0, 3, 1, 2)
+
+
+def tensor_to_clip(tensor):
+    return tensor.permute(0, 2, 3, 1).numpy()
 
 
 def crop_clip(clip, min_h, min_w, h, w):
     if isinstance(clip[0], np.ndarray):
-        cropped = [img[min_h:min_h + h, min_w:min_w + w, :] for img in clip]
+        cropped = np.asarray(clip)[:, min_h:min_h + h, min_w:min_w + w, :]
 
     elif isinstance(clip[0], PIL.Image.Image):
         cropped = [
@@ -51,10 +57,13 @@ def resize_clip(clip, size, interpolation='bilinear'):
         else:
             size = size[1], size[0]
 
-        scaled = [
-            resize(img, size, order=1 if interpolation == 'bilinear' else 0, preserve_range=True,
-                   mode='constant', anti_aliasing=True) for img in clip
-            ]
+        # The whole clip is resized at once
+        if interpolation == 'bilinear':
+            scaled = F.interpolate(clip_to_tensor(clip), size=size, mode='bilinear', align_corners=False,
+                                   antialias=True)
+        else:
+            scaled = F.interpolate(clip_to_tensor(clip), size=size, mode='nearest')
+        scaled = tensor_to_clip(scaled)
     elif isinstance(clip[0], PIL.Image.Image):
         if isinstance(size, numbers.Number):
             im_w, im_h = clip[0].size
@@ -96,6 +105,8 @@ class RandomFlip(object):
         if random.random() < 0.5 and self.time_flip:
             return clip[::-1]
         if random.random() < 0.5 and self.horizontal_flip:
+            if isinstance(clip[0], np.ndarray):
+                return np.asarray(clip)[:, :, ::-1]
             return [np.fliplr(img) for img in clip]
 
         return clip
@@ -203,7 +214,15 @@ class RandomRotation(object):
         """
         angle = random.uniform(self.degrees[0], self.degrees[1])
         if isinstance(clip[0], np.ndarray):
-            rotated = [rotate(image=img, angle=angle, preserve_range=True) for img in clip]
+            # Counter-clockwise around the center with zero padding, as skimage.transform.rotate,
+            # for the whole clip at once
+            clip = clip_to_tensor(clip)
+            h, w = clip.shape[2:]
+            cos, sin = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+            theta = torch.tensor([[cos, -sin * h / w, 0], [sin * w / h, cos, 0]], dtype=clip.dtype)
+            grid = F.affine_grid(theta.unsqueeze(0).repeat(clip.shape[0], 1, 1), clip.shape, align_corners=False)
+            rotated = tensor_to_clip(F.grid_sample(clip, grid, mode='bilinear', padding_mode='zeros',
+                                                   align_corners=False))
         elif isinstance(clip[0], PIL.Image.Image):
             rotated = [img.rotate(angle) for img in clip]
         else:
@@ -213,6 +232,32 @@ class RandomRotation(object):
         return rotated
 
 
+def rgb_to_grayscale(clip):
+    # ITU-R 601-2 luma, as PIL
+    return clip @ np.array([0.299, 0.587, 0.114], dtype=clip.dtype)
+
+
+def adjust_brightness(clip, brightness_factor):
+    return np.clip(clip * brightness_factor, 0, 1)
+
+
+def adjust_contrast(clip, contrast_factor):
+    mean = rgb_to_grayscale(clip).mean(axis=(1, 2))[:, np.newaxis, np.newaxis, np.newaxis]
+    return np.clip(mean + contrast_factor * (clip - mean), 0, 1)
+
+
+def adjust_saturation(clip, saturation_factor):
+    gray = rgb_to_grayscale(clip)[..., np.newaxis]
+    return np.clip(gray + saturation_factor * (clip - gray), 0, 1)
+
+
+def adjust_hue(clip, hue_factor):
+    # rgb2hsv takes a single image, frames are stacked along the height
+    hsv = rgb2hsv(clip.reshape((-1,) + clip.shape[2:]))
+    hsv[..., 0] = (hsv[..., 0] + hue_factor) % 1
+    return hsv2rgb(hsv).reshape(clip.shape).astype(clip.dtype)
+
+
 class ColorJitter(object):
     """Randomly change the brightness, contrast and saturation and hue of the clip
     Args:
@@ -268,28 +313,21 @@ class ColorJitter(object):
             brightness, contrast, saturation, hue = self.get_params(
                 self.brightness, self.contrast, self.saturation, self.hue)
 
-            # Create img transform function sequence
-            img_transforms = []
+            # Create clip transform function sequence, each applied to the whole clip at once
+            clip_transforms = []
             if brightness is not None:
-                img_transforms.append(lambda img: torchvision.transforms.functional.adjust_brightness(img, brightness))
+                clip_transforms.append(lambda clip: adjust_brightness(clip, brightness))
             if saturation is not None:
-                img_transforms.append(lambda img: torchvision.transforms.functional.adjust_saturation(img, saturation))
+                clip_transforms.append(lambda clip: adjust_saturation(clip, saturation))
             if hue is not None:
-                img_transforms.append(lambda img: torchvision.transforms.functional.adjust_hue(img, hue))
+                clip_transforms.append(lambda clip: adjust_hue(clip, hue))
             if contrast is not None:
-                img_transforms.append(lambda img: torchvision.transforms.functional.adjust_contrast(img, contrast))
-            random.shuffle(img_transforms)
-            img_transforms = [img_as_ubyte, torchvision.transforms.ToPILImage()] + img_transforms + [np.array,
-                                                                                                     img_as_float]
-
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                jittered_clip = []
-                for img in clip:
-                    jittered_img = img
-                    for func in img_transforms:
-                        jittered_img = func(jittered_img)
-                    jittered_clip.append(jittered_img.astype('float32'))
+                clip_transforms.append(lambda clip: adjust_contrast(clip, contrast))
+            random.shuffle(clip_transforms)
+
+            jittered_clip = np.asarray(clip, dtype=np.float32)
+            for func in clip_transforms:
+                jittered_clip = func(jittered_clip)
         elif isinstance(clip[0], PIL.Image.Image):
             brightness, contrast, saturation, hue = self.get_params(
                 self.brightness, self.contrast, self.saturation, self.hue)
@@ -342,3 +380,166 @@ class AllAugmentationTransform:
         for t in self.transforms:
             clip = t(clip)
         return clip
+
+
+def rgb_to_hsv(img):
+    """
+    HSV of a tensor of RGB images with channels in dimension -3, all values in [0, 1].
+    """
+    r, g, b = img.unbind(dim=-3)
+    maxc = img.max(dim=-3).values
+    minc = img.min(dim=-3).values
+    delta = maxc - minc
+    s = delta / torch.where(maxc == 0, torch.ones_like(maxc), maxc)
+    delta_c = torch.where(delta == 0, torch.ones_like(delta), delta)
+    rc = (maxc - r) / delta_c
+    gc = (maxc - g) / delta_c
+    bc = (maxc - b) / delta_c
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta == 0, torch.zeros_like(h), (h / 6.0) % 1.0)
+    return torch.stack([h, s, maxc], dim=-3)
+
+
+def hsv_to_rgb(hsv):
+    h, s, v = hsv.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    r = torch.stack([v, q, p, p, t, v]).gather(0, i.unsqueeze(0)).squeeze(0)
+    g = torch.stack([t, v, v, q, p, p]).gather(0, i.unsqueeze(0)).squeeze(0)
+    b = torch.stack([p, p, t, v, v, q]).gather(0, i.unsqueeze(0)).squeeze(0)
+    return torch.stack([r, g, b], dim=-3)
+
+
+class BatchAugmentation:
+    """
+    AllAugmentationTransform for a batch of (source, driving) pairs on the compute device.
+    Every sample draws its own parameters, which are shared by its two frames, from the same
+    distributions as the per-sample transforms. Resizing is only supported together with
+    cropping, so that all samples keep the same size.
+    """
+
+    def __init__(self, resize_param=None, rotation_param=None, flip_param=None, crop_param=None, jitter_param=None):
+        self.flip_param = flip_param
+        self.rotation = RandomRotation(**rotation_param) if rotation_param is not None else None
+        self.resize = RandomResize(**resize_param) if resize_param is not None else None
+        self.crop = RandomCrop(**crop_param) if crop_param is not None else None
+        self.jitter = ColorJitter(**jitter_param) if jitter_param is not None else None
+        if self.resize is not None and self.crop is None:
+            raise ValueError("Resizing on the device needs crop_param, so that all samples keep the same size")
+
+    def uniform(self, low, high, bs, device):
+        return low + (high - low) * torch.rand(bs, device=device)
+
+    def flip(self, frames):
+        bs = frames.shape[0]
+        # As RandomFlip, a horizontal flip is only drawn if the time flip was not applied
+        time_flip = (torch.rand(bs, device=frames.device) < 0.5) & self.flip_param.get('time_flip', False)
+        horizontal_flip = (torch.rand(bs, device=frames.device) < 0.5) & self.flip_param.get('horizontal_flip', False)
+        horizontal_flip = horizontal_flip & ~time_flip
+        frames = torch.where(time_flip.view(bs, 1, 1, 1, 1), frames.flip(1), frames)
+        return torch.where(horizontal_flip.view(bs, 1, 1, 1, 1), frames.flip(-1), frames)
+
+    def warp(self, frames, theta, size, mode, padding_mode):
+        bs, num_frames, c = frames.shape[:3]
+        theta = theta.repeat_interleave(num_frames, dim=0)
+        frames = frames.flatten(0, 1)
+        grid = F.affine_grid(theta, (bs * num_frames, c) + tuple(size), align_corners=False)
+        frames = F.grid_sample(frames, grid, mode=mode, padding_mode=padding_mode, align_corners=False)
+        return frames.view((bs, num_frames, c) + tuple(size))
+
+    def rotate(self, frames):
+        bs, _, _, h, w = frames.shape
+        angle = torch.deg2rad(self.uniform(self.rotation.degrees[0], self.rotation.degrees[1], bs, frames.device))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        zeros = torch.zeros_like(angle)
+        theta = torch.stack([torch.stack([cos, -sin * h / w, zeros], dim=1),
+                             torch.stack([sin * w / h, cos, zeros], dim=1)], dim=1)
+        return self.warp(frames, theta, (h, w), mode='bilinear', padding_mode='zeros')
+
+    def resize_and_crop(self, frames):
+        """
+        RandomResize followed by RandomCrop as a single affine warp, with the edge padding of
+        RandomCrop where the resized frames are smaller than the crop.
+        """
+        bs, _, _, h, w = frames.shape
+        crop_h, crop_w = self.crop.size
+        if self.resize is not None:
+            scale = self.uniform(self.resize.ratio[0], self.resize.ratio[1], bs, frames.device)
+        else:
+            scale = torch.ones(bs, device=frames.device)
+        new_h = torch.floor(h * scale)
+        new_w = torch.floor(w * scale)
+
+        def offset(new, crop):
+            random_offset = torch.floor(torch.rand(bs, device=frames.device) * (new - crop + 1))
+            return torch.where(new >= crop, random_offset, -torch.div(crop - new, 2, rounding_mode='floor'))
+
+        y1 = offset(new_h, crop_h)
+        x1 = offset(new_w, crop_w)
+        zeros = torch.zeros_like(scale)
+        theta = torch.stack([torch.stack([crop_w / new_w, zeros, (crop_w + 2 * x1) / new_w - 1], dim=1),
+                             torch.stack([zeros, crop_h / new_h, (crop_h + 2 * y1) / new_h - 1], dim=1)], dim=1)
+        mode = 'bilinear' if self.resize is None or self.resize.interpolation == 'bilinear' else 'nearest'
+        return self.warp(frames, theta, (crop_h, crop_w), mode=mode, padding_mode='border')
+
+    def color_jitter(self, frames):
+        bs = frames.shape[0]
+        device = frames.device
+
+        weights = torch.tensor([0.299, 0.587, 0.114], device=device).view(1, 1, 3, 1, 1)
+
+        def gray(frames):
+            return (frames * weights).sum(2, keepdim=True)
+
+        def brightness(frames, factor):
+            return (frames * factor).clamp(0, 1)
+
+        def contrast(frames, factor):
+            mean = gray(frames).mean(dim=(3, 4), keepdim=True)
+            return (mean + factor * (frames - mean)).clamp(0, 1)
+
+        def saturation(frames, factor):
+            gray_frames = gray(frames)
+            return (gray_frames + factor * (frames - gray_frames)).clamp(0, 1)
+
+        def hue(frames, factor):
+            hsv = rgb_to_hsv(frames)
+            hsv = torch.cat([(hsv[:, :, :1] + factor) % 1.0, hsv[:, :, 1:]], dim=2)
+            return hsv_to_rgb(hsv)
+
+        transforms = []
+        for func, value in [(brightness, self.jitter.brightness), (contrast, self.jitter.contrast),
+                            (saturation, self.jitter.saturation)]:
+            if value > 0:
+                transforms.append((func, self.uniform(max(0, 1 - value), 1 + value, bs, device)))
+        if self.jitter.hue > 0:
+            transforms.append((hue, self.uniform(-self.jitter.hue, self.jitter.hue, bs, device)))
+
+        # Every sample applies the transforms in its own random order. At every step each transform
+        # only runs on the samples that apply it at that step, so every step transforms the batch once.
+        order = torch.rand(bs, len(transforms), device=device).argsort(dim=1)
+        frames = frames.clone()
+        for step in range(len(transforms)):
+            for transform_idx, (func, factor) in enumerate(transforms):
+                selected = torch.nonzero(order[:, step] == transform_idx).squeeze(1)
+                if len(selected) > 0:
+                    frames[selected] = func(frames[selected], factor[selected].view(-1, 1, 1, 1, 1))
+        return frames
+
+    def __call__(self, source, driving):
+        frames = torch.stack([source, driving], dim=1)
+        if frames.dtype == torch.uint8:
+            frames = frames.float() / 255
+        if self.flip_param is not None:
+            frames = self.flip(frames)
+        if self.rotation is not None:
+            frames = self.rotate(frames)
+        if self.crop is not None:
+            frames = self.resize_and_crop(frames)
+        if self.jitter is not None:
+            frames = self.color_jitter(frames)
+        return frames[:, 0], frames[:, 1]
@@ -0,0 +1,254 @@
+import matplotlib
+
+matplotlib.use('Agg')
+import os
+import socket
+import time
+from argparse import ArgumentParser
+
+import imageio
+import numpy as np
+import torch
+import torch.distributed as dist
+import yaml
+from skimage.transform import resize
+from torch.nn.parallel import DistributedDataParallel
+
+from demo import load_checkpoints, make_animation, read_and_resize_frames
+from modules.inpainting_network import InpaintingNetwork
+from modules.keypoint_detector import KPDetector
+from modules.bg_motion_predictor import BGMotionPredictor
+from modules.dense_motion import DenseMotionNetwork
+from modules.model import GeneratorFullModel
+from cpu_distributed import numa_nodes, setup_cpu_process
+
+
+def run_animation(source_image, driving_video, networks, device, mode, motion_shape):
+    start = time.time()
+    predictions = np.array(list(make_animation(source_image, driving_video, *networks, device=device, mode=mode,
+                                               motion_shape=motion_shape)))
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return predictions, (time.time() - start) / len(driving_video)
+
+
+def benchmark_decoupled(opt, device):
+    """
+    Compare animation with keypoints and dense motion estimated at full resolution against
+    estimation on a low-resolution copy (--motion_shape). When no source image is given the
+    first driving frame is used, so the L1 against the driving video is the reconstruction error.
+    """
+    driving_video = list(read_and_resize_frames(opt.driving_video, opt.img_shape))[:opt.num_frames]
+    if opt.source_image is None:
+        source_image = driving_video[0]
+    else:
+        source_image = resize(imageio.imread(opt.source_image), opt.img_shape)[..., :3]
+    networks = load_checkpoints(config_path=opt.config, checkpoint_path=opt.checkpoint, device=device)
+
+    # Warm up so that the first timing does not include cudnn autotuning and allocations
+    run_animation(source_image, driving_video[:2], networks, device, opt.animate_mode, None)
+
+    full, full_time = run_animation(source_image, driving_video, networks, device, opt.animate_mode, None)
+    low, low_time = run_animation(source_image, driving_video, networks, device, opt.animate_mode, opt.motion_shape)
+
+    driving = np.array(driving_video, dtype=np.float32)
+    mse = ((full - low) ** 2).mean()
+    print("Motion shape %s: %.1f ms/frame, full resolution: %.1f ms/frame, speedup x%.2f" %
+          (opt.motion_shape, 1000 * low_time, 1000 * full_time, full_time / low_time))
+    print("L1 to driving: full resolution %.5f, motion shape %.5f" %
+          (np.abs(full - driving).mean(), np.abs(low - driving).mean()))
+    print("Difference to full resolution output: L1 %.5f, PSNR %.2f dB" %
+          (np.abs(full - low).mean(), 10 * np.log10(1 / max(mse, 1e-12))))
+
+
+def build_networks(config, device):
+    inpainting = InpaintingNetwork(**config['model_params']['generator_params'],
+                                   **config['model_params']['common_params'])
+    kp_detector = KPDetector(**config['model_params']['common_params'])
+    dense_motion_network = DenseMotionNetwork(**config['model_params']['common_params'],
+                                              **config['model_params']['dense_motion_params'])
+    bg_predictor = None
+    if config['model_params']['common_params']['bg']:
+        bg_predictor = BGMotionPredictor().to(device)
+    # In the argument order of GeneratorFullModel
+    return kp_detector.to(device), bg_predictor, dense_motion_network.to(device), inpainting.to(device)
+
+
+def time_training_steps(generator_full, x, num_steps, device):
+    """
+    Mean time of a forward and backward pass of generator_full, and its peak memory in MB on cuda.
+    """
+    def step():
+        losses, _ = generator_full(x, 0)
+        sum(value.mean() for value in losses.values()).backward()
+        generator_full.zero_grad(set_to_none=True)
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(num_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        return (time.time() - start) / num_steps, torch.cuda.max_memory_allocated() / 2 ** 20
+    return (time.time() - start) / num_steps, None
+
+
+def benchmark_checkpointing(opt, device):
+    """
+    Time and peak memory of a training step at --img_shape and --batch_size without activation checkpointing,
+    with checkpointing of every module of train_params.checkpointing alone and of all of them.
+    """
+    with open(opt.config) as f:
+        config = yaml.full_load(f)
+    networks = build_networks(config, device)
+    x = {'source': torch.rand(opt.batch_size, 3, *opt.img_shape, device=device),
+         'driving': torch.rand(opt.batch_size, 3, *opt.img_shape, device=device)}
+
+    modules = ['hourglass', 'inpainting', 'vgg']
+    settings = [('none', {})] + [(module, {module: True}) for module in modules]
+    settings.append(('all', {module: True for module in modules}))
+    base_time, base_memory = None, None
+    for name, checkpointing in settings:
+        train_params = dict(config['train_params'], checkpointing=checkpointing)
+        generator_full = GeneratorFullModel(*networks, train_params).to(device)
+        step_time, memory = time_training_steps(generator_full, x, opt.num_steps, device)
+        if base_time is None:
+            base_time, base_memory = step_time, memory
+        report = "Checkpointing %s: %.1f ms/step (x%.2f)" % (name, 1000 * step_time, step_time / base_time)
+        if memory is not None:
+            report += ", peak memory %.0f MB (x%.2f)" % (memory, memory / base_memory)
+        print(report)
+
+
+def benchmark_precision(opt, device):
+    """
+    Losses, gradient norm, drift of the driving keypoints and time of a training step under bf16 (and on
+    cuda fp16) autocast against float32, on the same batch and random draws. With --cpu this validates the mixed precision policy
+    with bf16 autocast on CPU.
+    """
+    with open(opt.config) as f:
+        config = yaml.full_load(f)
+    train_params = config['train_params']
+    generator_full = GeneratorFullModel(*build_networks(config, device), train_params).to(device)
+    x = {'source': torch.rand(opt.batch_size, 3, *opt.img_shape, device=device),
+         'driving': torch.rand(opt.batch_size, 3, *opt.img_shape, device=device)}
+    # Without dropout, the only random draw is the equivariance TPS, which is seeded
+    epoch = train_params['dropout_epoch']
+    # Warm up so that the float32 timing does not include allocations
+    with torch.no_grad():
+        generator_full(x, epoch)
+
+    precisions = [('fp32', None), ('bf16', torch.bfloat16)]
+    if device.type == 'cuda':
+        precisions.append(('fp16', torch.float16))
+    reference = None
+    for name, dtype in precisions:
+        torch.manual_seed(0)
+        start = time.time()
+        with torch.autocast(device_type=device.type, dtype=dtype, enabled=dtype is not None):
+            losses, generated = generator_full(x, epoch)
+        kp_driving = generated['kp_driving']['fg_kp'].detach().float()
+        losses = {key: value.mean().float() for key, value in losses.items()}
+        sum(losses.values()).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        step_time = time.time() - start
+        grad_norm = torch.norm(torch.stack([param.grad.norm() for param in generator_full.parameters()
+                                            if param.grad is not None])).item()
+        generator_full.zero_grad(set_to_none=True)
+
+        losses = {key: value.item() for key, value in losses.items()}
+        if reference is None:
+            reference = losses, grad_norm, kp_driving
+        report = "%s: %.1f ms/step, gradient norm %.4g (%+.2f%%), keypoint drift max %.2e mean %.2e" % (
+            name, 1000 * step_time, grad_norm, 100 * (grad_norm / reference[1] - 1),
+            (kp_driving - reference[2]).abs().max(), (kp_driving - reference[2]).abs().mean())
+        for key, value in losses.items():
+            if reference[0][key] != 0:
+                report += ", %s %.5g (%+.2f%%)" % (key, value, 100 * (value / reference[0][key] - 1))
+            else:
+                report += ", %s %.5g" % (key, value)
+        print(report)
+        if not all(np.isfinite(list(losses.values()))) or not np.isfinite(grad_norm):
+            print("%s: non-finite loss or gradient" % name)
+
+
+def scaling_worker(rank, world_size, nodes, config, opt, results):
+    setup_cpu_process(rank, world_size, nodes)
+    device = torch.device('cpu')
+    generator_full = GeneratorFullModel(*build_networks(config, device), config['train_params'])
+    # The background predictor is not used before bg_start
+    generator_full = DistributedDataParallel(generator_full, find_unused_parameters=True)
+    x = {'source': torch.rand(opt.batch_size, 3, *opt.img_shape),
+         'driving': torch.rand(opt.batch_size, 3, *opt.img_shape)}
+    step_time, _ = time_training_steps(generator_full, x, opt.num_steps, device)
+    dist.destroy_process_group()
+    if rank == 0:
+        results.put(step_time)
+
+
+def benchmark_scaling(opt):
+    """
+    Throughput of data-parallel training steps on the CPU with 1 to --num_processes gloo processes, one per
+    NUMA node by default, each pinned to the cores of its node with a batch of --batch_size. The scaling
+    efficiency is the throughput relative to that many times the throughput of a single process.
+    """
+    with open(opt.config) as f:
+        config = yaml.full_load(f)
+    nodes = numa_nodes()
+    results = torch.multiprocessing.get_context('spawn').SimpleQueue()
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    base_throughput = None
+    for world_size in range(1, (opt.num_processes or len(nodes)) + 1):
+        # A free port for the process group of every run
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            os.environ['MASTER_PORT'] = str(sock.getsockname()[1])
+        torch.multiprocessing.spawn(scaling_worker, args=(world_size, nodes, config, opt, results), nprocs=world_size)
+        step_time = results.get()
+        throughput = world_size * opt.batch_size / step_time
+        if base_throughput is None:
+            base_throughput = throughput
+        print("%d processes: %.1f ms/step, %.1f samples/s, scaling efficiency %.0f%%" % (
+            world_size, 1000 * step_time, throughput, 100 * throughput / (world_size * base_throughput)))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--mode", default="decoupled", choices=["decoupled", "checkpointing", "precision", "scaling"],
+                        help="what to benchmark")
+    parser.add_argument("--config", required=True, help="path to config")
+    parser.add_argument("--checkpoint", default='checkpoints/vox.pth.tar', help="path to checkpoint to restore")
+    parser.add_argument("--source_image", default=None, help="path to source image, first driving frame if not set")
+    parser.add_argument("--driving_video", default='./assets/driving.mp4', help="path to driving video")
+    parser.add_argument("--num_frames", default=100, type=int, help="number of driving frames to animate")
+    parser.add_argument("--img_shape", default="512,512", type=lambda x: list(map(int, x.split(','))),
+                        help='Shape of image, that the model was trained on.')
+    parser.add_argument("--motion_shape", default="256,256", type=lambda x: list(map(int, x.split(','))),
+                        help='Shape at which keypoints and dense motion are estimated.')
+    parser.add_argument("--animate_mode", dest="animate_mode", default='relative',
+                        choices=['standard', 'relative', 'avd'], help="Animate mode")
+    parser.add_argument("--batch_size", default=4, type=int, help="batch size of the training steps")
+    parser.add_argument("--num_steps", default=5, type=int, help="number of timed training steps")
+    parser.add_argument("--num_processes", default=None, type=int,
+                        help="largest number of processes in scaling mode, one per NUMA node if not set")
+    parser.add_argument("--cpu", dest="cpu", action="store_true", help="cpu mode.")
+
+    opt = parser.parse_args()
+
+    if opt.cpu or torch.cuda.device_count() == 0:
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda')
+
+    if opt.mode == 'decoupled':
+        benchmark_decoupled(opt, device)
+    elif opt.mode == 'checkpointing':
+        benchmark_checkpointing(opt, device)
+    elif opt.mode == 'precision':
+        benchmark_precision(opt, device)
+    elif opt.mode == 'scaling':
+        benchmark_scaling(opt)
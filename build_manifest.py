@@ -0,0 +1,82 @@
+"""
+Scan a dataset once and write root_dir/manifest.json, which FramesDataset then uses instead of
+listing folders and globbing for videos of an id on every sample.
+
+Every video is opened in a process pool to record its number of frames, frame shape and id.
+Videos that cannot be read are reported and left out of the manifest.
+"""
+import os
+import json
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+from skimage import io
+from tqdm import tqdm
+
+from frames_dataset import read_video, read_video_frames, count_video_frames, list_splits, MANIFEST, VIDEO_EXTENSIONS
+
+
+def scan_frames_folder(path, video):
+    frames = sorted(os.listdir(path))
+    name, ext = os.path.splitext(frames[0])
+    frame_format = '%0' + str(len(name)) + 'd' + ext
+    # Zero-padded frame numbers are stored as a format instead of the list of names
+    if frames == [frame_format % idx for idx in range(len(frames))]:
+        video['frame_format'] = frame_format
+    else:
+        video['frames'] = frames
+    first = io.imread(os.path.join(path, frames[0]))
+    io.imread(os.path.join(path, frames[-1]))
+    return len(frames), first.shape
+
+
+def scan_video(args):
+    path, frame_shape = args
+    name = os.path.basename(path)
+    video = {'name': name, 'id': name.split('#')[0]}
+    try:
+        if os.path.isdir(path):
+            num_frames, shape = scan_frames_folder(path, video)
+        elif path.lower().endswith(VIDEO_EXTENSIONS):
+            num_frames = count_video_frames(path)
+            shape = read_video_frames(path, [0, num_frames - 1], frame_shape=None).shape[1:]
+        else:
+            frames = read_video(path, frame_shape=frame_shape)
+            num_frames, shape = len(frames), frames.shape[1:]
+        if num_frames == 0:
+            raise Exception("Video without frames")
+    except Exception as e:
+        return path, None, str(e)
+
+    video['num_frames'] = num_frames
+    video['shape'] = list(shape)
+    return path, video, None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--root_dir", required=True, help="dataset to scan, as root_dir in the config")
+    parser.add_argument("--frame_shape", default=None, type=lambda x: tuple(map(int, x.split(','))),
+                        help="frame_shape of the config, needed for images of concatenated frames")
+    parser.add_argument("--random_seed", default=0, type=int, help="random_seed of the config")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="number of scanning processes")
+
+    opt = parser.parse_args()
+
+    manifest = {'random_seed': opt.random_seed, 'corrupt': []}
+    with Pool(opt.workers) as pool:
+        for split, paths in list_splits(opt.root_dir, opt.random_seed).items():
+            videos = []
+            for path, video, error in tqdm(pool.imap_unordered(scan_video, [(path, opt.frame_shape) for path in paths],
+                                                               chunksize=16), total=len(paths)):
+                if video is None:
+                    print("Error reading video: %s (%s)" % (path, error))
+                    manifest['corrupt'].append(os.path.relpath(path, opt.root_dir))
+                else:
+                    videos.append(video)
+            manifest[split] = sorted(videos, key=lambda video: video['name'])
+
+    with open(os.path.join(opt.root_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    print("Train: %d, test: %d, corrupt: %d" %
+          (len(manifest['train']), len(manifest['test']), len(manifest['corrupt'])))
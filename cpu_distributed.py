@@ -0,0 +1,101 @@
+"""
+Data-parallel training on multi-core CPU nodes, with one process per NUMA node and the gloo backend.
+
+    python cpu_distributed.py run.py --mode train --config config/dataset_name.yaml
+
+starts run.py in one process per NUMA node (or --num_processes) through torch.distributed.run.
+Every process is pinned to the cores of its node and runs that many intra-op threads, and
+the Accelerator of train.py and train_avd.py then trains on the CPU over the gloo process group.
+"""
+import os
+from argparse import ArgumentParser, REMAINDER
+
+import torch
+import torch.distributed as dist
+from torch.distributed.run import main as torchrun
+
+CPU_DISTRIBUTED = 'CPU_DISTRIBUTED'
+CPU_THREADS = 'CPU_THREADS'
+
+
+def parse_cpulist(text):
+    """
+    CPUs of a cpulist such as '0-3,8-11'.
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """
+    CPUs of every NUMA node that this process may run on. A single node with all its CPUs if the
+    topology is not available.
+    """
+    allowed = os.sched_getaffinity(0)
+    root = '/sys/devices/system/node'
+    nodes = []
+    if os.path.isdir(root):
+        for name in sorted(os.listdir(root)):
+            if name.startswith('node') and name[4:].isdigit():
+                with open(os.path.join(root, name, 'cpulist')) as f:
+                    cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+                if cpus:
+                    nodes.append(cpus)
+    return nodes or [sorted(allowed)]
+
+
+def setup_cpu_process(rank, world_size, nodes=None, num_threads=None):
+    """
+    Pin process rank to the cores of its NUMA node, set its number of threads and join the gloo
+    process group. MASTER_ADDR and MASTER_PORT should be set.
+    """
+    nodes = nodes or numa_nodes()
+    cpus = nodes[rank % len(nodes)]
+    if world_size > len(nodes):
+        # Processes sharing a node split its cores, or share them if there are less cores than processes
+        shared = [r for r in range(world_size) if r % len(nodes) == rank % len(nodes)]
+        cpus = cpus[shared.index(rank)::len(shared)] or cpus
+    os.sched_setaffinity(0, cpus)
+    num_threads = num_threads or len(cpus)
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    if not dist.is_initialized():
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+
+def init_cpu_distributed():
+    """
+    Set up a process started by this launcher, before the Accelerator is created. Returns whether
+    training runs on the CPU, to be passed as cpu to the Accelerator.
+    """
+    if os.environ.get(CPU_DISTRIBUTED) != '1':
+        return False
+    num_threads = int(os.environ[CPU_THREADS]) if os.environ.get(CPU_THREADS) else None
+    setup_cpu_process(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), num_threads=num_threads)
+    return True
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--num_processes", default=None, type=int,
+                        help="number of processes, one per NUMA node if not set")
+    parser.add_argument("--threads", default=None, type=int,
+                        help="intra-op threads of every process, the cores of its NUMA node if not set")
+    parser.add_argument("script", help="training script, e.g. run.py")
+    parser.add_argument("script_args", nargs=REMAINDER, help="arguments of the training script")
+
+    opt = parser.parse_args()
+
+    num_processes = opt.num_processes or len(numa_nodes())
+    os.environ[CPU_DISTRIBUTED] = '1'
+    os.environ['ACCELERATE_USE_CPU'] = 'true'
+    if opt.threads is not None:
+        os.environ[CPU_THREADS] = str(opt.threads)
+
+    torchrun(['--standalone', '--nproc_per_node', str(num_processes), opt.script] + opt.script_args)
@@ -14,6 +14,7 @@ import imageio
 from skimage.transform import resize
 from skimage import img_as_ubyte
 import torch
+import torch.nn.functional as F
 from modules.inpainting_network import InpaintingNetwork
 from modules.keypoint_detector import KPDetector
 from modules.dense_motion import DenseMotionNetwork
@@ -69,8 +70,40 @@ def load_checkpoints(config_path, checkpoint_path, device):
     return inpainting, kp_detector, dense_motion_network, avd_network
 
 
+def downsample_frame(frame, motion_shape):
+    if motion_shape is None or tuple(frame.shape[2:]) == tuple(motion_shape):
+        return frame
+    return F.interpolate(frame, size=tuple(motion_shape), mode='bilinear', align_corners=False, antialias=True)
+
+
+def upsample_dense_motion(dense_motion, motion_shape, img_shape):
+    """
+    Bring deformation and occlusion maps estimated on frames of motion_shape to the
+    resolution expected by the inpainting network for frames of img_shape. The deformation
+    is expressed in normalized coordinates, so only its sampling grid has to be resized.
+    """
+    ratio = (img_shape[0] / motion_shape[0], img_shape[1] / motion_shape[1])
+    out = {k: v for k, v in dense_motion.items()}
+
+    deformation = dense_motion['deformation'].permute(0, 3, 1, 2)
+    deformation = F.interpolate(deformation, scale_factor=ratio, mode='bilinear', align_corners=True)
+    out['deformation'] = deformation.permute(0, 2, 3, 1)
+
+    out['occlusion_map'] = []
+    for occlusion_map in dense_motion['occlusion_map']:
+        size = (round(occlusion_map.shape[2] * ratio[0]), round(occlusion_map.shape[3] * ratio[1]))
+        out['occlusion_map'].append(F.interpolate(occlusion_map, size=size, mode='bilinear', align_corners=True))
+    return out
+
+
 def make_animation(source_image, driving_video_generator, inpainting_network, kp_detector, dense_motion_network,
-                   avd_network, device: torch.device, mode='relative', autocast_dtype=torch.float16, autocast=False):
+                   avd_network, device: torch.device, mode='relative', autocast_dtype=torch.float16, autocast=False,
+                   motion_shape=None, tile_memory_budget=None):
+    """
+    If motion_shape is given, keypoints and dense motion are estimated on frames resized to
+    motion_shape, while the inpainting network still runs at the resolution of source_image.
+    If tile_memory_budget (bytes) is given, the inpainting decoder runs over tiles sized to fit it.
+    """
     assert mode in ['standard', 'relative', 'avd']
     with torch.no_grad():
 
@@ -82,7 +115,10 @@ def make_animation(source_image, driving_video_generator, inpainting_network, kp
         with autocast_context:
             source = torch.tensor(source_image[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2)
             source = source.to(device)
-            kp_source = kp_detector(source)
+            source_motion = downsample_frame(source, motion_shape)
+            kp_source = kp_detector(source_motion)
+            # The source is fixed, so it is encoded once for all frames
+            source_encoder_map = inpainting_network.encode(source)
 
             first_frame = True
 
@@ -90,6 +126,7 @@ def make_animation(source_image, driving_video_generator, inpainting_network, kp
 
                 driving_frame = torch.tensor(driving_frame_np[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2).to(
                     device)
+                driving_frame = downsample_frame(driving_frame, motion_shape)
                 if first_frame:
                     kp_driving_initial = kp_detector(driving_frame)
                     first_frame = False
@@ -101,10 +138,16 @@ def make_animation(source_image, driving_video_generator, inpainting_network, kp
                                           kp_driving_initial=kp_driving_initial)
                 elif mode == 'avd':
                     kp_norm = avd_network(kp_source, kp_driving)
-                dense_motion = dense_motion_network(source_image=source, kp_driving=kp_norm,
+                dense_motion = dense_motion_network(source_image=source_motion, kp_driving=kp_norm,
                                                     kp_source=kp_source, bg_param=None,
-                                                    dropout_flag=False)
-                out = inpainting_network(source, dense_motion)
+                                                    dropout_flag=False, inference=True)
+                if source_motion is not source:
+                    dense_motion = upsample_dense_motion(dense_motion, source_motion.shape[2:], source.shape[2:])
+                if tile_memory_budget is not None:
+                    out = inpainting_network.forward_tiled(source, dense_motion, memory_budget=tile_memory_budget,
+                                                           encoder_map=source_encoder_map)
+                else:
+                    out = inpainting_network(source, dense_motion, inference=True, encoder_map=source_encoder_map)
 
                 yield np.transpose(out['prediction'].data.cpu().numpy(), [0, 2, 3, 1])[0]
 
@@ -181,6 +224,12 @@ if __name__ == "__main__":
 
     parser.add_argument("--img_shape", default="256,256", type=lambda x: list(map(int, x.split(','))),
                         help='Shape of image, that the model was trained on.')
+    parser.add_argument("--motion_shape", default=None, type=lambda x: list(map(int, x.split(','))),
+                        help='Shape at which keypoints and dense motion are estimated, e.g. 256,256 for the 512/768 '
+                             'finetuned models. Defaults to img_shape.')
+    parser.add_argument("--tile_memory_budget", default=None, type=lambda x: int(float(x) * 2 ** 20),
+                        help='Memory budget in MB for the inpainting network. If set, its decoder runs over '
+                             'overlapping tiles sized to fit the budget.')
 
     parser.add_argument("--mode", default='relative', choices=['standard', 'relative', 'avd'],
                         help="Animate mode: ['standard', 'relative', 'avd'], when use the relative mode to animate a face, use '--find_best_frame' can get better quality result")
@@ -245,7 +294,9 @@ if __name__ == "__main__":
             # Generate and append frames for the reversed backward animation
             backward_animation = make_animation(source_image, driving_backward, inpainting, kp_detector,
                                                 dense_motion_network, avd_network, device=device, mode=opt.mode,
-                                                autocast_dtype=autocast_dtype, autocast=opt.autocast)
+                                                autocast_dtype=autocast_dtype, autocast=opt.autocast,
+                                                motion_shape=opt.motion_shape,
+                                                tile_memory_budget=opt.tile_memory_budget)
 
             for frame in reversed_generator(backward_animation):
                 append_frame_to_writer(frame, writer)
@@ -254,7 +305,8 @@ if __name__ == "__main__":
             for idx, frame in tqdm(enumerate(
                     make_animation(source_image, driving_forward, inpainting, kp_detector, dense_motion_network,
                                    avd_network, device=device, mode=opt.mode, autocast_dtype=autocast_dtype,
-                                   autocast=opt.autocast
+                                   autocast=opt.autocast, motion_shape=opt.motion_shape,
+                                   tile_memory_budget=opt.tile_memory_budget
                                    )), total=length):
                 if idx == 0:
                     continue
@@ -265,6 +317,7 @@ if __name__ == "__main__":
             for frame in tqdm(
                     make_animation(source_image, driving_video_generator, inpainting, kp_detector, dense_motion_network,
                                    avd_network, device=device, mode=opt.mode, autocast_dtype=autocast_dtype,
-                                   autocast=opt.autocast
+                                   autocast=opt.autocast, motion_shape=opt.motion_shape,
+                                   tile_memory_budget=opt.tile_memory_budget
                                    ), total=length):
                 append_frame_to_writer(frame, writer)
@@ -1,104 +1,186 @@
+"""
+Crop square face videos out of a directory of raw videos, in the layout FramesDataset trains from.
+
+Faces are detected with dlib on a downscaled grayscale copy of every --detect_every-th frame.
+The box is interpolated between detections and smoothed with an exponential moving average, and
+every frame from the first detection on is cropped to a square around it and resized to --size.
+Videos are processed in parallel, and written to out_dir/train and out_dir/test as '.mp4' or as
+folders of '.png' frames. Use out_dir as root_dir and --size as frame_shape in the config.
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
 import cv2
 import dlib
-import sys
+import numpy as np
+from sklearn.model_selection import train_test_split
+from tqdm import tqdm
 
-def detect_and_track_face(input_video, output_video):
-    # Initialize face detector and shape predictor
-    face_detector = dlib.get_frontal_face_detector()
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
 
-    # Open input video
-    cap = cv2.VideoCapture(input_video)
-    if not cap.isOpened():
-        print("Error opening video file")
-        sys.exit()
-
-    # Get video properties
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-
-    # Initialize video writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = None
-
-    # Exponential moving average (EMA) for smoother bounding box
-    alpha_location = 0.1
-    alpha_dimensions = 0.01
-    ema_location = None
-    ema_dimensions = None
-    output_size = None
-    while cap.isOpened():
-        ret, frame = cap.read()
+# Exponential moving average (EMA) for smoother bounding box
+ALPHA_LOCATION = 0.1
+ALPHA_DIMENSIONS = 0.01
 
-        if not ret:
-            break
-
-        # Detect faces
-        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_detector(gray_frame)
+face_detector = None
 
 
-        # Update face bounding box if a face is detected
-        if len(faces) > 0:
-            face = faces[0]
-            x, y, w, h = face.left(), face.top(), face.width(), face.height()
-            center_x, center_y = x + w // 2, y + h // 2
+def init_worker():
+    global face_detector
+    face_detector = dlib.get_frontal_face_detector()
 
-            # Update EMA for bounding box
-            # Update EMA for bounding box location (center) and dimensions
-            if ema_location is None:
-                ema_location = (center_x, center_y)
-                ema_dimensions = (w, h)
-            else:
-                ema_location = (
-                    alpha_location * center_x + (1 - alpha_location) * ema_location[0],
-                    alpha_location * center_y + (1 - alpha_location) * ema_location[1]
-                )
-                ema_dimensions = (
-                    alpha_dimensions * w + (1 - alpha_dimensions) * ema_dimensions[0],
-                    alpha_dimensions * h + (1 - alpha_dimensions) * ema_dimensions[1]
-                )
-
-        # Use the last detected face bounding box if no face is detected
-        if ema_location is not None and ema_dimensions is not None:
-            # Calculate the square bounding box with 10% margin
-            max_dim = int(max(ema_dimensions[0], ema_dimensions[1]) * 2)
-
-            if output_size is None:
-                output_size = (max_dim, max_dim)
-
-            x1 = max(0, int(ema_location[0] - max_dim // 2))
-            y1 = max(0, int(ema_location[1] - max_dim // 2))
-            x2 = min(x1 + max_dim, frame.shape[1])
-            y2 = min(y1 + max_dim, frame.shape[0])
-
-            # Crop the face and pad to maintain a consistent size
-            cropped_face = frame[y1:y2, x1:x2]
-
-            if output_size is None:
-                pass
-            else:
-                cropped_face = cv2.resize(cropped_face, output_size)
 
-            print(cropped_face.shape)
+def detect_face(frame, detect_size):
+    """
+    (center_x, center_y, width, height) of the largest face in frame, or None. Detection runs on
+    a grayscale copy whose longest side is at most detect_size.
+    """
+    scale = min(1.0, detect_size / max(frame.shape[:2]))
+    if scale < 1:
+        frame = cv2.resize(frame, (round(frame.shape[1] * scale), round(frame.shape[0] * scale)),
+                           interpolation=cv2.INTER_AREA)
+    faces = face_detector(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    if len(faces) == 0:
+        return None
+    face = max(faces, key=lambda face: face.area())
+    return ((face.left() + face.width() / 2) / scale, (face.top() + face.height() / 2) / scale,
+            face.width() / scale, face.height() / scale)
+
+
+def track_face(input_video, detect_every, detect_size):
+    """
+    Smoothed face box of every frame from the first detection on, as an array of
+    (center_x, center_y, width, height), and the index of the first of these frames.
+    Frames between detections are grabbed without being decoded to images.
+    """
+    cap = cv2.VideoCapture(input_video)
+    if not cap.isOpened():
+        raise IOError("Error opening video file")
+
+    detected_idx, detected_boxes = [], []
+    num_frames = 0
+    while True:
+        if num_frames % detect_every == 0:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            face = detect_face(frame, detect_size)
+            if face is not None:
+                detected_idx.append(num_frames)
+                detected_boxes.append(face)
+        elif not cap.grab():
+            break
+        num_frames += 1
+    cap.release()
 
-            # Set the output video size based on the first cropped face
-            if out is None:
-                out = cv2.VideoWriter(output_video, fourcc, fps, output_size)
+    if not detected_idx:
+        return None, None
+
+    # Linear interpolation between detections, the last detection is held until the end
+    first = detected_idx[0]
+    frame_idx = np.arange(first, num_frames)
+    detected_boxes = np.array(detected_boxes)
+    boxes = np.stack([np.interp(frame_idx, detected_idx, detected_boxes[:, i]) for i in range(4)], axis=1)
+
+    alpha = np.array([ALPHA_LOCATION, ALPHA_LOCATION, ALPHA_DIMENSIONS, ALPHA_DIMENSIONS])
+    for i in range(1, len(boxes)):
+        boxes[i] = alpha * boxes[i] + (1 - alpha) * boxes[i - 1]
+    return boxes, first
+
+
+def crop_square(frame, box, margin, size):
+    """
+    Square of side margin * max(width, height) around the box, shifted to stay inside the frame.
+    """
+    center_x, center_y, width, height = box
+    side = int(min(max(width, height) * margin, frame.shape[0], frame.shape[1]))
+    x1 = int(min(max(0, center_x - side // 2), frame.shape[1] - side))
+    y1 = int(min(max(0, center_y - side // 2), frame.shape[0] - side))
+    return cv2.resize(frame[y1:y1 + side, x1:x1 + side], (size, size), interpolation=cv2.INTER_AREA)
+
+
+def detect_and_track_face(input_video, output_video, size=256, margin=2.0, detect_every=5, detect_size=320,
+                          image_format='mp4'):
+    """
+    Write the square face crops of input_video to output_video, a '.mp4' or a folder of '.png'
+    frames. Returns the number of frames written.
+    """
+    boxes, first = track_face(input_video, detect_every, detect_size)
+    if boxes is None:
+        return 0
 
-            # Write the cropped face to the output video
-            out.write(cropped_face)
-            cv2.imshow("Cropped Face", cropped_face)
+    cap = cv2.VideoCapture(input_video)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    if image_format == 'png':
+        os.makedirs(output_video, exist_ok=True)
+    else:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(output_video, fourcc, fps, (size, size))
+
+    frame_idx = 0
+    num_written = 0
+    while num_written < len(boxes):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame_idx >= first:
+            cropped_face = crop_square(frame, boxes[frame_idx - first], margin, size)
+            if image_format == 'png':
+                cv2.imwrite(os.path.join(output_video, '%07d.png' % num_written), cropped_face)
+            else:
+                out.write(cropped_face)
+            num_written += 1
+        frame_idx += 1
 
-    # Release the video capture, video writer, and close all windows
     cap.release()
-    if out is not None:
+    if image_format != 'png':
         out.release()
-    cv2.destroyAllWindows()
+    return num_written
 
 
+def process_video(args):
+    input_video, output_video, kwargs = args
+    try:
+        return input_video, detect_and_track_face(input_video, output_video, **kwargs), None
+    except Exception as e:
+        return input_video, 0, str(e)
 
 
 if __name__ == "__main__":
-    input_video = "lawrence_original.mp4"
-    output_video = "tracked_face_6.mp4"
-
-    detect_and_track_face(input_video, output_video)
\ No newline at end of file
+    parser = ArgumentParser()
+    parser.add_argument("--in_dir", required=True, help="directory of raw videos")
+    parser.add_argument("--out_dir", required=True, help="dataset to write, used as root_dir in the config")
+    parser.add_argument("--size", default=256, type=int, help="side of the output frames")
+    parser.add_argument("--margin", default=2.0, type=float, help="side of the crop relative to the face box")
+    parser.add_argument("--detect_every", default=5, type=int, help="run the face detector every N frames")
+    parser.add_argument("--detect_size", default=320, type=int,
+                        help="longest side of the downscaled frames the face detector runs on")
+    parser.add_argument("--format", default='mp4', choices=['mp4', 'png'],
+                        help="write '.mp4' videos or folders of '.png' frames")
+    parser.add_argument("--test_size", default=0.2, type=float, help="fraction of the videos in the test split")
+    parser.add_argument("--random_seed", default=0, type=int, help="seed of the train/test split")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="number of processes")
+
+    opt = parser.parse_args()
+
+    videos = sorted(name for name in os.listdir(opt.in_dir) if name.lower().endswith(VIDEO_EXTENSIONS))
+    train_videos, test_videos = train_test_split(videos, random_state=opt.random_seed, test_size=opt.test_size)
+    kwargs = {'size': opt.size, 'margin': opt.margin, 'detect_every': opt.detect_every,
+              'detect_size': opt.detect_size, 'image_format': opt.format}
+
+    jobs = []
+    for split, split_videos in [('train', train_videos), ('test', test_videos)]:
+        os.makedirs(os.path.join(opt.out_dir, split), exist_ok=True)
+        for name in split_videos:
+            output_name = os.path.splitext(name)[0] + ('.mp4' if opt.format == 'mp4' else '')
+            jobs.append((os.path.join(opt.in_dir, name), os.path.join(opt.out_dir, split, output_name), kwargs))
+
+    skipped = []
+    with Pool(opt.workers, initializer=init_worker) as pool:
+        for path, num_frames, error in tqdm(pool.imap_unordered(process_video, jobs), total=len(jobs)):
+            if error is not None or num_frames == 0:
+                skipped.append(path)
+                print("Skipped %s: %s" % (path, error or "no face detected"))
+
+    print("Cropped %d videos, skipped %d" % (len(jobs) - len(skipped), len(skipped)))
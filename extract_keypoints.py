@@ -0,0 +1,97 @@
+"""
+Extract the keypoints of every frame of the training videos once, for train_avd without image i/o.
+
+The frozen keypoint detector of --checkpoint runs over all frames of the train split of the dataset of
+the config (raw, packed by pack_dataset.py or with a manifest). The keypoints are stored back to back as
+float32 in out_dir/keypoints.npy, and out_dir/index.json gives the offset, number of frames and id of
+every video, with the checkpoint and a digest of the keypoint detector weights. Set keypoints_dir: out_dir
+in train_avd_params to train the AVD network from them.
+"""
+import os
+import json
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import yaml
+from tqdm import tqdm
+
+from frames_dataset import list_splits, weights_digest, PackedVideos, PACKED_INDEX, KEYPOINTS
+from modules.keypoint_detector import KPDetector
+from pack_dataset import load_video
+
+
+def train_videos(root_dir, frame_shape, random_seed, workers):
+    """
+    (name, id, uint8 frames) of every video of the train split, decoded in parallel.
+    """
+    packed_dir = os.path.join(root_dir, 'train')
+    if os.path.isfile(os.path.join(packed_dir, PACKED_INDEX)):
+        packed = PackedVideos(packed_dir, frame_shape=frame_shape)
+        for name, video in packed.videos.items():
+            yield name, video['id'], packed.read(name, range(video['num_frames']))
+        return
+
+    videos = list_splits(root_dir, random_seed)['train']
+    with Pool(workers) as pool:
+        for path, video in pool.imap(load_video, [(path, frame_shape) for path in videos]):
+            if video is None or len(video) == 0:
+                continue
+            name = os.path.basename(path)
+            yield name, name.split('#')[0], video
+
+
+def extract_keypoints(kp_detector, video, batch_size, device):
+    """
+    float32 keypoints of every frame of a uint8 video, as an array of shape (num_frames, num_tps * 5, 2).
+    """
+    keypoints = []
+    for start in range(0, len(video), batch_size):
+        frames = torch.from_numpy(np.array(video[start:start + batch_size])).to(device)
+        frames = frames.permute(0, 3, 1, 2).float() / 255
+        keypoints.append(kp_detector(frames)['fg_kp'].float().cpu().numpy())
+    return np.concatenate(keypoints)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", required=True, help="path to config")
+    parser.add_argument("--checkpoint", required=True, help="checkpoint with the keypoint detector to train AVD for")
+    parser.add_argument("--out_dir", required=True, help="path of the keypoints, as keypoints_dir in the config")
+    parser.add_argument("--batch_size", default=256, type=int, help="frames per keypoint detector pass")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="number of decoding processes")
+    parser.add_argument("--cpu", dest="cpu", action="store_true", help="cpu mode.")
+
+    opt = parser.parse_args()
+    with open(opt.config) as f:
+        config = yaml.full_load(f)
+
+    if opt.cpu or torch.cuda.device_count() == 0:
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda')
+
+    kp_detector = KPDetector(**config['model_params']['common_params'])
+    kp_detector.load_state_dict(torch.load(opt.checkpoint, map_location=device)['kp_detector'])
+    kp_detector.to(device).eval()
+
+    dataset_params = config['dataset_params']
+    index = {'checkpoint': os.path.abspath(opt.checkpoint), 'kp_detector_digest': weights_digest(kp_detector),
+             'videos': []}
+    keypoints = []
+    num_frames = 0
+    videos = train_videos(dataset_params['root_dir'], dataset_params.get('frame_shape', (256, 256, 3)),
+                          dataset_params.get('random_seed', 0), opt.workers)
+    with torch.no_grad():
+        for name, video_id, video in tqdm(videos):
+            keypoints.append(extract_keypoints(kp_detector, video, opt.batch_size, device))
+            index['videos'].append({'name': name, 'id': video_id, 'offset': num_frames, 'num_frames': len(video)})
+            num_frames += len(video)
+
+    if not os.path.exists(opt.out_dir):
+        os.makedirs(opt.out_dir)
+    np.save(os.path.join(opt.out_dir, KEYPOINTS), np.concatenate(keypoints))
+    with open(os.path.join(opt.out_dir, PACKED_INDEX), 'w') as f:
+        json.dump(index, f)
+    print("Extracted keypoints of %d frames of %d videos" % (num_frames, len(index['videos'])))
@@ -0,0 +1,143 @@
+import atexit
+import threading
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+
+def open_block(name=None, size=0):
+    block = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+    # Blocks are owned by the cache index, which unlinks them on eviction, not by the process that opened them
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+def unlink_block(name):
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+class FrameCacheIndex:
+    """
+    LRU index of the videos in the cache. It lives in the manager process and is shared by all
+    DataLoader workers, every entry pointing to a shared memory block with the uint8 frames.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The manager serves every worker from its own thread
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def insert(self, key, name, shape, nbytes):
+        with self.lock:
+            if key in self.entries or nbytes > self.capacity:
+                return False
+            while self.size + nbytes > self.capacity:
+                _, (old_name, _, old_nbytes) = self.entries.popitem(last=False)
+                unlink_block(old_name)
+                self.size -= old_nbytes
+                self.evictions += 1
+            self.entries[key] = (name, shape, nbytes)
+            self.size += nbytes
+            return True
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / requests if requests else 0, 'videos': len(self.entries),
+                    'size': self.size, 'capacity': self.capacity}
+
+    def clear(self):
+        with self.lock:
+            for name, _, _ in self.entries.values():
+                unlink_block(name)
+            self.entries.clear()
+            self.size = 0
+
+
+class FrameCacheManager(BaseManager):
+    pass
+
+
+FrameCacheManager.register('FrameCacheIndex', FrameCacheIndex)
+
+
+class SharedFrameCache:
+    """
+    LRU cache of decoded uint8 videos in shared memory, shared by all DataLoader workers so that
+    a video decoded by one worker is not decoded again by the others. capacity is in bytes.
+    Should be created in the main process, before the DataLoader starts its workers.
+    """
+
+    def __init__(self, capacity):
+        self.manager = FrameCacheManager()
+        self.manager.start()
+        self.capacity = capacity
+        self.index = self.manager.FrameCacheIndex(capacity)
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        # Only the index proxy is sent to workers started with spawn
+        return {'manager': None, 'capacity': self.capacity, 'index': self.index}
+
+    def get(self, key, select=None):
+        """
+        Copy of the cached frames of key, or None if they are not in the cache. select maps the
+        number of frames to the indices of the frames to copy.
+        """
+        entry = self.index.lookup(key)
+        if entry is None:
+            return None
+        name, shape, _ = entry
+        try:
+            block = open_block(name)
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            return None
+        video = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+        if select is not None:
+            frames = np.take(video, select(shape[0]), axis=0)
+        else:
+            frames = video.copy()
+        # The block can only be closed once no array points into it
+        del video
+        block.close()
+        return frames
+
+    def put(self, key, frames):
+        block = open_block(size=max(frames.nbytes, 1))
+        np.ndarray(frames.shape, dtype=np.uint8, buffer=block.buf)[:] = frames
+        block.close()
+        if not self.index.insert(key, block.name, frames.shape, frames.nbytes):
+            unlink_block(block.name)
+
+    def stats(self):
+        return self.index.stats()
+
+    def close(self):
+        if self.manager is not None:
+            self.index.clear()
+            self.manager.shutdown()
+            self.manager = None
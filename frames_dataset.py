@@ -1,13 +1,19 @@
 import os
-from skimage import io, img_as_float32
+from skimage import io, img_as_float32, img_as_ubyte
 from skimage.color import gray2rgb
 from sklearn.model_selection import train_test_split
+import imageio
 from imageio import mimread
 from skimage.transform import resize
 import numpy as np
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
 from augmentation import AllAugmentationTransform
+from frame_cache import SharedFrameCache
 import glob
+import hashlib
+import json
 from functools import partial
 
 
@@ -55,6 +61,117 @@ def read_video(name, frame_shape):
     return video_array
 
 
+VIDEO_EXTENSIONS = ('.gif', '.mp4', '.mov')
+
+
+def count_video_frames(name):
+    """
+    Number of frames in a '.mp4', '.gif' or '.mov' video.
+    """
+    with imageio.get_reader(name) as reader:
+        if hasattr(reader, 'count_frames'):
+            # The ffmpeg reader only estimates its length from the metadata
+            return reader.count_frames()
+        return reader.get_length()
+
+
+def read_video_frames(name, frame_idx, frame_shape):
+    """
+    Decode only the frames frame_idx of a '.mp4', '.gif' or '.mov' video. The reader seeks to
+    the keyframe before each requested frame instead of decoding the whole video.
+    """
+    frames = {}
+    with imageio.get_reader(name) as reader:
+        # In increasing order, so that the reader only seeks forward
+        for idx in sorted(set(frame_idx)):
+            frames[idx] = reader.get_data(idx)
+
+    video = []
+    for idx in frame_idx:
+        frame = frames[idx]
+        if len(frame.shape) == 2:
+            frame = gray2rgb(frame)
+        if frame.shape[-1] == 4:
+            frame = frame[..., :3]
+        if frame_shape is not None:
+            frame = resize(frame, frame_shape)
+        video.append(img_as_float32(frame))
+    return np.array(video)
+
+
+PACKED_INDEX = 'index.json'
+MANIFEST = 'manifest.json'
+KEYPOINTS = 'keypoints.npy'
+
+
+def list_splits(root_dir, random_seed):
+    """
+    Paths of the train and test videos, split the same way as in FramesDataset.
+    """
+    if os.path.exists(os.path.join(root_dir, 'train')):
+        assert os.path.exists(os.path.join(root_dir, 'test'))
+        return {split: [os.path.join(root_dir, split, name)
+                        for name in sorted(os.listdir(os.path.join(root_dir, split)))] for split in ('train', 'test')}
+
+    videos = [name for name in os.listdir(root_dir) if name != MANIFEST]
+    train_videos, test_videos = train_test_split(videos, random_state=random_seed, test_size=0.2)
+    return {'train': [os.path.join(root_dir, name) for name in sorted(train_videos)],
+            'test': [os.path.join(root_dir, name) for name in sorted(test_videos)]}
+
+
+def manifest_frames(video):
+    """
+    Names of the frames of a folder video recorded by build_manifest.py.
+    """
+    if 'frames' in video:
+        return video['frames']
+    return [video['frame_format'] % idx for idx in range(video['num_frames'])]
+
+
+class PackedVideos:
+    """
+    Videos of one split packed by pack_dataset.py. Frames of all videos are stored back to back
+    as uint8 arrays in .npy shards, which are memory-mapped on first access, and index.json gives
+    the shard, offset, number of frames and id of every video. All frames should have the same
+    shape, frame_shape if it is given.
+    """
+
+    def __init__(self, split_dir, frame_shape=None):
+        self.split_dir = split_dir
+        with open(os.path.join(split_dir, PACKED_INDEX)) as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        # Only the headers of the shards are read
+        shapes = {np.load(os.path.join(split_dir, shard), mmap_mode='r').shape[1:] for shard in self.shards}
+        assert len(shapes) <= 1, "Frames of different shapes in %s, pack it with --frame_shape" % split_dir
+        if frame_shape is not None and shapes:
+            assert shapes == {tuple(frame_shape)}, \
+                "Frames of %s are not of frame_shape %s, pack it with --frame_shape" % (split_dir, tuple(frame_shape))
+        self.videos = {video['name']: video for video in index['videos']}
+        self.ids = {}
+        for name, video in self.videos.items():
+            self.ids.setdefault(video['id'], []).append(name)
+        self.shard_maps = {}
+
+    def num_frames(self, name):
+        return self.videos[name]['num_frames']
+
+    def read(self, name, frame_idx):
+        """
+        uint8 frames frame_idx of the video, indexed straight from the memory-mapped shard.
+        A range gives a view of the shard without any copy.
+        """
+        video = self.videos[name]
+        shard = video['shard']
+        if shard not in self.shard_maps:
+            # Opened lazily, so that every DataLoader worker gets its own mapping
+            self.shard_maps[shard] = np.load(os.path.join(self.split_dir, self.shards[shard]), mmap_mode='r')
+        frames = self.shard_maps[shard]
+        if isinstance(frame_idx, range):
+            return frames[video['offset'] + frame_idx.start:video['offset'] + frame_idx.stop]
+        return frames[video['offset'] + np.asarray(frame_idx)]
+
+
 class FramesDataset(Dataset):
     """
     Dataset of videos, each video can be represented as:
@@ -64,15 +181,45 @@ class FramesDataset(Dataset):
     """
 
     def __init__(self, root_dir, frame_shape=(256, 256, 3), id_sampling=False, is_train=True,
-                 random_seed=0, pairs_list=None, augmentation_params=None):
+                 random_seed=0, pairs_list=None, augmentation_params=None, pairs_per_video=1, cache_size=0,
+                 augmentation_on_device=False, uint8_frames=False):
         self.root_dir = root_dir
         self.videos = os.listdir(root_dir)
         self.frame_shape = frame_shape
         print(self.frame_shape)
         self.pairs_list = pairs_list
         self.id_sampling = id_sampling
+        # Independent (source, driving) pairs sampled from every loaded video in training
+        self.pairs_per_video = pairs_per_video
+        self.packed = None
+        self.manifest = None
 
-        if os.path.exists(os.path.join(root_dir, 'train')):
+        if os.path.isfile(os.path.join(root_dir, 'train', PACKED_INDEX)):
+            assert os.path.isfile(os.path.join(root_dir, 'test', PACKED_INDEX))
+            self.root_dir = os.path.join(self.root_dir, 'train' if is_train else 'test')
+            self.packed = PackedVideos(self.root_dir, frame_shape=frame_shape)
+            if is_train and id_sampling:
+                train_videos = sorted(self.packed.ids)
+            else:
+                train_videos = sorted(self.packed.videos)
+            test_videos = sorted(self.packed.videos)
+        elif os.path.isfile(os.path.join(root_dir, MANIFEST)):
+            with open(os.path.join(root_dir, MANIFEST)) as f:
+                manifest = json.load(f)
+            if os.path.exists(os.path.join(root_dir, 'train')):
+                self.root_dir = os.path.join(self.root_dir, 'train' if is_train else 'test')
+            else:
+                assert manifest['random_seed'] == random_seed, "The manifest was built for another random_seed"
+            self.manifest = {video['name']: video for video in manifest['train' if is_train else 'test']}
+            self.manifest_ids = {}
+            for name, video in self.manifest.items():
+                self.manifest_ids.setdefault(video['id'], []).append(name)
+            if is_train and id_sampling:
+                train_videos = sorted(self.manifest_ids)
+            else:
+                train_videos = sorted(self.manifest)
+            test_videos = sorted(self.manifest)
+        elif os.path.exists(os.path.join(root_dir, 'train')):
             assert os.path.exists(os.path.join(root_dir, 'test'))
             if id_sampling:
                 train_videos = {os.path.basename(video).split('#')[0] for video in
@@ -91,31 +238,124 @@ class FramesDataset(Dataset):
             self.videos = test_videos
 
         self.is_train = is_train
-
-        if self.is_train:
+        # Per-video frame counts, filled lazily so that sampled frames can be decoded directly. They are
+        # gathered per worker, so the training DataLoaders keep their workers (persistent_workers)
+        self.num_frames_index = {}
+        if self.manifest is not None:
+            self.num_frames_index = {os.path.join(self.root_dir, name): video['num_frames']
+                                     for name, video in self.manifest.items()}
+
+        # With augmentation_on_device the training pairs are left as uint8 for BatchAugmentation
+        self.augmentation_on_device = augmentation_on_device
+        # Frames are sent to the trainer as uint8 and converted to float on the device, see frames_to_float
+        self.uint8_frames = uint8_frames or augmentation_on_device
+        if self.is_train and not augmentation_on_device:
             self.transform = AllAugmentationTransform(**augmentation_params)
         else:
             self.transform = None
 
+        # Decoded videos shared by all DataLoader workers, cache_size is in MB
+        self.cache = None
+        if self.is_train and cache_size > 0 and self.packed is None:
+            self.cache = SharedFrameCache(cache_size * 2 ** 20)
+        # Whether every visited video fits in the cache, see fits_in_cache
+        self.cache_fits = {}
+
     def __len__(self):
         return len(self.videos)
 
+    def sample_frame_idx(self, num_frames):
+        """
+        pairs_per_video sorted pairs of frame indices, flattened.
+        """
+        frame_idx = np.random.choice(num_frames, replace=True, size=(self.pairs_per_video, 2))
+        return np.sort(frame_idx, axis=1).reshape(-1)
+
+    def fits_in_cache(self, path):
+        """
+        Whether the decoded frames of the video at path fit in the cache. Only the sampled frames of
+        larger videos are decoded, as without the cache.
+        """
+        if not os.path.isdir(path) and not path.lower().endswith(VIDEO_EXTENSIONS):
+            # Images of concatenated frames are decoded entirely with or without the cache
+            return self.frame_shape is not None
+        if path not in self.cache_fits:
+            self.cache_fits[path] = self.video_nbytes(path) <= self.cache.capacity
+        return self.cache_fits[path]
+
+    def video_nbytes(self, path):
+        """
+        Size of the decoded uint8 frames of the video or frames folder at path. The frame size is frame_shape,
+        else the shape in the manifest or of the first frame.
+        """
+        if path in self.num_frames_index:
+            num_frames = self.num_frames_index[path]
+        elif path.lower().endswith(VIDEO_EXTENSIONS):
+            num_frames = self.num_frames_index[path] = count_video_frames(path)
+        else:
+            num_frames = len(os.listdir(path))
+
+        name = os.path.basename(path)
+        if self.frame_shape is not None:
+            frame_shape = self.frame_shape
+        elif self.manifest is not None and name in self.manifest:
+            frame_shape = self.manifest[name]['shape']
+        elif os.path.isdir(path):
+            frame_shape = io.imread(os.path.join(path, sorted(os.listdir(path))[0])).shape
+        else:
+            with imageio.get_reader(path) as reader:
+                frame_shape = reader.get_data(0).shape
+        # Decoded frames have 3 channels
+        return num_frames * int(np.prod(frame_shape[:2])) * 3
+
+    def output_frames(self, frames):
+        """
+        Frames as a uint8 array if uint8_frames is set, else as float32 in [0, 1].
+        """
+        frames = np.array(frames)
+        if not self.uint8_frames:
+            return img_as_float32(frames)
+        if frames.dtype != np.uint8:
+            frames = img_as_ubyte(np.clip(frames, 0, 1))
+        return frames
+
     def __getitem__(self, idx):
         path = None
         try:
-            if self.is_train and self.id_sampling:
+            if self.packed is not None:
+                path = self.videos[idx]
+                if self.is_train and self.id_sampling:
+                    path = np.random.choice(self.packed.ids[path])
+            elif self.is_train and self.id_sampling:
                 name = self.videos[idx]
-                path = np.random.choice(glob.glob(os.path.join(self.root_dir, name + '*.mp4')))
+                if self.manifest is not None:
+                    path = os.path.join(self.root_dir, np.random.choice(self.manifest_ids[name]))
+                else:
+                    path = np.random.choice(glob.glob(os.path.join(self.root_dir, name + '*.mp4')))
             else:
                 name = self.videos[idx]
                 path = os.path.join(self.root_dir, name)
 
             video_name = os.path.basename(path)
-            if self.is_train and os.path.isdir(path):
-
-                frames = os.listdir(path)
+            if self.packed is not None:
+                num_frames = self.packed.num_frames(path)
+                frame_idx = self.sample_frame_idx(num_frames) if self.is_train else range(
+                    num_frames)
+                video_array = self.packed.read(path, frame_idx)
+            elif self.cache is not None and self.fits_in_cache(path):
+                video_array = self.cache.get(path, select=self.sample_frame_idx)
+                if video_array is None:
+                    video = img_as_ubyte(read_video(path, frame_shape=self.frame_shape))
+                    self.cache.put(path, video)
+                    video_array = video[self.sample_frame_idx(len(video))]
+            elif self.is_train and os.path.isdir(path):
+
+                if self.manifest is not None:
+                    frames = manifest_frames(self.manifest[video_name])
+                else:
+                    frames = os.listdir(path)
                 num_frames = len(frames)
-                frame_idx = np.sort(np.random.choice(num_frames, replace=True, size=2))
+                frame_idx = self.sample_frame_idx(num_frames)
 
                 if self.frame_shape is not None:
                     resize_fn = partial(resize, output_shape=self.frame_shape)
@@ -127,28 +367,39 @@ class FramesDataset(Dataset):
                                 frame_idx]
                 else:
                     video_array = [resize_fn(io.imread(os.path.join(path, frames[idx]))) for idx in frame_idx]
+            elif self.is_train and path.lower().endswith(VIDEO_EXTENSIONS):
+                if path not in self.num_frames_index:
+                    self.num_frames_index[path] = count_video_frames(path)
+                num_frames = self.num_frames_index[path]
+                frame_idx = self.sample_frame_idx(num_frames)
+                video_array = read_video_frames(path, frame_idx, frame_shape=self.frame_shape)
             else:
 
                 video_array = read_video(path, frame_shape=self.frame_shape)
 
                 num_frames = len(video_array)
-                frame_idx = np.sort(np.random.choice(num_frames, replace=True, size=2)) if self.is_train else range(
+                frame_idx = self.sample_frame_idx(num_frames) if self.is_train else range(
                     num_frames)
                 video_array = video_array[frame_idx]
 
 
-            if self.transform is not None:
-                video_array = self.transform(video_array)
-
             out = {}
             if self.is_train:
-                source = np.array(video_array[0], dtype='float32')
-                driving = np.array(video_array[1], dtype='float32')
-
-                out['driving'] = driving.transpose((2, 0, 1))
-                out['source'] = source.transpose((2, 0, 1))
+                pairs = [video_array[2 * i:2 * i + 2] for i in range(self.pairs_per_video)]
+                if self.transform is not None:
+                    pairs = [self.transform(img_as_float32(np.array(pair))) for pair in pairs]
+                source = self.output_frames([pair[0] for pair in pairs])
+                driving = self.output_frames([pair[1] for pair in pairs])
+
+                out['driving'] = driving.transpose((0, 3, 1, 2))
+                out['source'] = source.transpose((0, 3, 1, 2))
+                if self.pairs_per_video == 1:
+                    out['driving'] = out['driving'][0]
+                    out['source'] = out['source'][0]
             else:
-                video = np.array(video_array, dtype='float32')
+                if self.transform is not None:
+                    video_array = self.transform(video_array)
+                video = self.output_frames(video_array)
                 out['video'] = video.transpose((3, 0, 1, 2))
 
             out['name'] = video_name
@@ -160,6 +411,114 @@ class FramesDataset(Dataset):
             return self.__getitem__(idx + 1)
 
 
+def weights_digest(module):
+    """
+    Digest of the weights of module, stored with the keypoints extracted by extract_keypoints.py to check
+    that they come from the keypoint detector that train_avd trains against.
+    """
+    digest = hashlib.sha1()
+    for name, value in sorted(module.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class KeypointsDataset(Dataset):
+    """
+    Keypoints of the training videos extracted by extract_keypoints.py, for train_avd without any image i/o.
+    Keypoints of all frames are stored back to back in keypoints.npy, memory-mapped on first access, and
+    index.json gives the offset, number of frames and id of every video. Pairs are sampled as in FramesDataset.
+    """
+
+    def __init__(self, keypoints_dir, id_sampling=False, pairs_per_video=1):
+        self.keypoints_dir = keypoints_dir
+        with open(os.path.join(keypoints_dir, PACKED_INDEX)) as f:
+            index = json.load(f)
+        self.index = {video['name']: video for video in index['videos']}
+        self.checkpoint = index.get('checkpoint')
+        self.kp_detector_digest = index.get('kp_detector_digest')
+        self.ids = {}
+        for name, video in self.index.items():
+            self.ids.setdefault(video['id'], []).append(name)
+        self.id_sampling = id_sampling
+        self.videos = sorted(self.ids) if id_sampling else sorted(self.index)
+        self.pairs_per_video = pairs_per_video
+        self.keypoints = None
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __getitem__(self, idx):
+        if self.keypoints is None:
+            # Opened lazily, so that every DataLoader worker gets its own mapping
+            self.keypoints = np.load(os.path.join(self.keypoints_dir, KEYPOINTS), mmap_mode='r')
+        name = self.videos[idx]
+        if self.id_sampling:
+            name = np.random.choice(self.ids[name])
+        video = self.index[name]
+
+        frame_idx = np.random.choice(video['num_frames'], replace=True, size=(self.pairs_per_video, 2))
+        keypoints = np.array(self.keypoints[video['offset'] + np.sort(frame_idx, axis=1)])
+
+        out = {'source': keypoints[:, 0], 'driving': keypoints[:, 1], 'name': name}
+        if self.pairs_per_video == 1:
+            out['source'] = out['source'][0]
+            out['driving'] = out['driving'][0]
+        return out
+
+
+def frames_to_float(frames):
+    """
+    Frames of a batch as float in [0, 1], for datasets with uint8_frames. Meant to run on the
+    compute device, so that only uint8 frames are copied from the workers.
+    """
+    if frames.dtype == torch.uint8:
+        return frames.float() / 255
+    return frames
+
+
+def collate_pairs(batch):
+    """
+    Collate samples of a FramesDataset with pairs_per_video > 1, so that the pairs of a video
+    fill consecutive slots of the batch.
+    """
+    out = default_collate(batch)
+    pairs_per_video = out['source'].shape[1]
+    out['source'] = out['source'].flatten(0, 1)
+    out['driving'] = out['driving'].flatten(0, 1)
+    out['name'] = [name for name in out['name'] for _ in range(pairs_per_video)]
+    return out
+
+
+class ResumableSampler(Sampler):
+    """
+    Random order of the dataset that only depends on seed and the epoch, so that an interrupted
+    epoch can be resumed from the position it had reached.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_position(self, epoch, start=0):
+        """
+        Iterate over the order of epoch, skipping its first start samples.
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator).tolist()
+        return iter(order[self.start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
 class DatasetRepeater(Dataset):
     """
     Pass several times over the same dataset for better i/o performance
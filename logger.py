@@ -10,52 +10,220 @@ from skimage.draw import circle
 
 import matplotlib.pyplot as plt
 import collections
-import wandb
+import glob
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import wandb
+except ImportError:
+    wandb = None
+
+
+# Checkpoint of a partially done epoch, see Logger.save_resume_state
+RESUME_STATE = 'resume.pth.tar'
+
+# Outputs of the generator drawn by Visualizer.visualize
+VISUALIZED_KEYS = ('kp_source', 'transformed_frame', 'transformed_kp', 'kp_driving', 'deformed', 'prediction',
+                   'kp_norm', 'occlusion_map', 'deformed_source', 'contribution_maps')
+
+
+def is_main_process():
+    """
+    Whether this is the first process of a distributed run, or the only process.
+    """
+    return not torch.distributed.is_available() or not torch.distributed.is_initialized() or \
+        torch.distributed.get_rank() == 0
+
+
+def snapshot(value):
+    """
+    Detached CPU copy of the tensors in value, a tensor or nested dicts, lists and tuples of them.
+    """
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
 
 
 class Logger:
+    """
+    Visualizations and checkpoints are snapshotted to the CPU and written by a background thread, in order.
+    Checkpoints are written atomically, and only the last keep_checkpoints of them are kept if it is set.
+    In a distributed run only the main process writes logs, metrics, visualizations and checkpoints.
+    """
+
     def __init__(self, log_dir, checkpoint_freq=50, visualizer_params=None,
-                 zfill_num=8, log_file_name='log.txt', models=()):
+                 zfill_num=8, log_file_name='log.txt', models=(), log_freq=1, metrics_file_name='metrics.jsonl',
+                 use_wandb=True, keep_checkpoints=None, main_process=None):
 
         self.models = None
-        self.loss_list = []
+        # Losses are summed on their device and only copied to the host every log_freq iterations
+        self.log_freq = log_freq
+        self.pending_losses = None
+        self.pending_count = 0
+        self.pending_others = None
+        self.epoch_losses = None
+        self.epoch_count = 0
+        self.step = 0
         self.cpk_dir = log_dir
+        self.main_process = is_main_process() if main_process is None else main_process
         self.visualizations_dir = os.path.join(log_dir, 'train-vis')
         if not os.path.exists(self.visualizations_dir):
-            os.makedirs(self.visualizations_dir)
-        self.log_file = open(os.path.join(log_dir, log_file_name), 'a')
+            os.makedirs(self.visualizations_dir, exist_ok=True)
+        if self.main_process:
+            self.log_file = open(os.path.join(log_dir, log_file_name), 'a')
+            self.metrics_file = open(os.path.join(log_dir, metrics_file_name), 'a')
+        else:
+            # The other processes of a distributed run keep their metrics to themselves
+            self.log_file = open(os.devnull, 'w')
+            self.metrics_file = open(os.devnull, 'w')
         self.zfill_num = zfill_num
         self.visualizer = Visualizer(**visualizer_params)
         self.checkpoint_freq = checkpoint_freq
+        self.keep_checkpoints = keep_checkpoints
+        self.background = ThreadPoolExecutor(max_workers=1)
+        self.background_tasks = []
         self.epoch = 0
         self.best_loss = float('inf')
         self.names = None
-        wandb.init(project="TPSMM", dir=log_dir)
-        for model in models:
-            wandb.watch(model)
+        self.use_wandb = use_wandb and wandb is not None and self.main_process
+        if self.use_wandb:
+            wandb.init(project="TPSMM", dir=log_dir)
+            for model in models:
+                wandb.watch(model)
 
     def log_scores(self, loss_names):
-        loss_mean = np.array(self.loss_list).mean(axis=0)
+        self.flush_metrics()
+        if self.epoch_count == 0:
+            return
+        loss_mean = self.epoch_losses / self.epoch_count
 
         loss_string = "; ".join(["%s - %.5f" % (name, value) for name, value in zip(loss_names, loss_mean)])
         loss_string = str(self.epoch).zfill(self.zfill_num) + ") " + loss_string
 
         print(loss_string, file=self.log_file)
-        self.loss_list = []
+        self.epoch_losses = None
+        self.epoch_count = 0
         self.log_file.flush()
 
+    def flush_metrics(self):
+        """
+        Copy the losses summed since the last flush to the host, add them to the epoch scores and write
+        their mean to the metrics file and wandb.
+        """
+        if self.pending_count == 0:
+            return
+        losses = self.pending_losses.cpu().numpy()
+        if self.epoch_losses is None:
+            self.epoch_losses = losses
+        else:
+            self.epoch_losses = self.epoch_losses + losses
+        self.epoch_count += self.pending_count
+
+        metrics = collections.OrderedDict(zip(self.names, (losses / self.pending_count).tolist()))
+        if self.pending_others is not None:
+            metrics.update((key, float(value)) for key, value in self.pending_others.items())
+        print(json.dumps(dict(metrics, step=self.step)), file=self.metrics_file)
+        self.metrics_file.flush()
+        if self.use_wandb:
+            wandb.log(metrics)
+
+        self.pending_losses = None
+        self.pending_count = 0
+
+    def log_message(self, message):
+        print(str(self.epoch).zfill(self.zfill_num) + ") " + message, file=self.log_file)
+        self.log_file.flush()
+
+    def log_telemetry(self, epoch, summary):
+        """
+        Write the Telemetry summary of epoch to log.txt and, as a JSON line, to telemetry.jsonl.
+        """
+        self.log_message("telemetry - " + "; ".join("%s %.4g" % item for item in summary.items()))
+        if not self.main_process:
+            return
+        with open(os.path.join(self.cpk_dir, 'telemetry.jsonl'), 'a') as f:
+            print(json.dumps(dict(summary, epoch=epoch)), file=f)
+
+    def run_in_background(self, function, *args):
+        # Errors of finished tasks are raised here instead of being lost
+        for task in self.background_tasks:
+            if task.done():
+                task.result()
+        self.background_tasks = [task for task in self.background_tasks if not task.done()]
+        self.background_tasks.append(self.background.submit(function, *args))
+
+    def wait_background(self):
+        for task in self.background_tasks:
+            task.result()
+        self.background_tasks = []
+
     def visualize_rec(self, inp, out):
+        if not self.main_process:
+            return
+        inp = snapshot({'driving': inp['driving'], 'source': inp['source']})
+        out = snapshot({key: value for key, value in out.items() if key in VISUALIZED_KEYS})
+        self.run_in_background(self.write_visualization, inp, out, self.epoch)
+
+    def write_visualization(self, inp, out, epoch):
         image = self.visualizer.visualize(inp['driving'], inp['source'], out)
-        imageio.imsave(os.path.join(self.visualizations_dir, "%s-rec.png" % str(self.epoch).zfill(self.zfill_num)),
+        imageio.imsave(os.path.join(self.visualizations_dir, "%s-rec.png" % str(epoch).zfill(self.zfill_num)),
                        image)
-        wandb.log({"image": [wandb.Image(image)]})
+        if self.use_wandb:
+            wandb.log({"image": [wandb.Image(image)]})
 
     def save_cpk(self, emergent=False):
-        cpk = {k: v.state_dict() for k, v in self.models.items()}
+        if not self.main_process:
+            return
+        cpk = {k: snapshot(v.state_dict()) for k, v in self.models.items()}
         cpk['epoch'] = self.epoch
         cpk_path = os.path.join(self.cpk_dir, '%s-checkpoint.pth.tar' % str(self.epoch).zfill(self.zfill_num))
         if not (os.path.exists(cpk_path) and emergent):
-            torch.save(cpk, cpk_path)
+            self.run_in_background(self.write_cpk, cpk, cpk_path)
+
+    def save_resume_state(self, models, state):
+        """
+        Checkpoint of the models in the middle of an epoch, with the extra state needed to resume from
+        there (position in the epoch, random states...), overwriting the previous one.
+        """
+        if not self.main_process:
+            return
+        cpk = {k: snapshot(v.state_dict()) for k, v in models.items()}
+        cpk.update(snapshot(state))
+        cpk['logger_step'] = self.step
+        self.run_in_background(self.write_cpk, cpk, os.path.join(self.cpk_dir, RESUME_STATE))
+
+    @staticmethod
+    def load_resume_state(checkpoint_path):
+        """
+        The extra state saved by save_resume_state, or None if checkpoint_path was saved at the end of an epoch.
+        """
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        if 'step' not in checkpoint:
+            return None
+        return checkpoint
+
+    def write_cpk(self, cpk, cpk_path):
+        # Written to a file of this process next to the destination and renamed, so that a checkpoint is never
+        # left half written
+        tmp_path = '%s.%d.tmp' % (cpk_path, os.getpid())
+        try:
+            torch.save(cpk, tmp_path)
+            os.replace(tmp_path, cpk_path)
+        except BaseException:
+            # torch.save may fail before the file is created
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.keep_checkpoints:
+            checkpoints = sorted(glob.glob(os.path.join(self.cpk_dir, '*-checkpoint.pth.tar')))
+            for old_path in checkpoints[:-self.keep_checkpoints]:
+                os.remove(old_path)
 
     @staticmethod
     def load_cpk(checkpoint_path, inpainting_network=None, dense_motion_network=None, kp_detector=None,
@@ -94,16 +262,31 @@ class Logger:
     def __exit__(self, exc_type, exc_value, tb):
         if 'models' in self.__dict__:
             self.save_cpk()
+        self.wait_background()
+        self.background.shutdown()
+        self.flush_metrics()
         self.log_file.close()
-        wandb.finish()
+        self.metrics_file.close()
+        if self.use_wandb:
+            wandb.finish()
 
     def log_iter(self, losses, others: Dict = None):
+        """
+        losses are scalar tensors, which can stay on the training device: they are summed there
+        without synchronizing, and copied to the host every log_freq iterations.
+        """
         losses = collections.OrderedDict(losses.items())
         self.names = list(losses.keys())
-        self.loss_list.append(list(losses.values()))
-        if others is not None:
-            losses.update(others)
-        wandb.log(losses)
+        values = torch.stack([torch.as_tensor(value).detach().float().reshape(()) for value in losses.values()])
+        if self.pending_losses is None:
+            self.pending_losses = values
+        else:
+            self.pending_losses = self.pending_losses + values
+        self.pending_count += 1
+        self.pending_others = others
+        self.step += 1
+        if self.pending_count >= self.log_freq:
+            self.flush_metrics()
 
     def log_epoch(self, epoch, models, inp, out):
         self.epoch = epoch
@@ -114,6 +297,60 @@ class Logger:
         self.visualize_rec(inp, out)
 
 
+class Telemetry:
+    """
+    Time breakdown of the training steps. The time since the previous lap is added to the named section.
+    With cuda the device is synchronized at every lap so that kernels are counted in the section that
+    launched them, which costs some throughput. Every call returns immediately when disabled.
+    """
+
+    def __init__(self, enabled=False, num_processes=1):
+        self.enabled = enabled
+        self.num_processes = num_processes
+        self.synchronize = enabled and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.sections = collections.OrderedDict()
+        self.steps = 0
+        self.samples = 0
+        self.last = None
+
+    def start(self):
+        if self.enabled:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.last = time.perf_counter()
+
+    def lap(self, name):
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.sections[name] = self.sections.get(name, 0) + now - self.last
+        self.last = now
+
+    def end_step(self, num_samples):
+        if self.enabled:
+            self.steps += 1
+            self.samples += num_samples
+
+    def summary(self):
+        """
+        Samples per second of all processes, share of the time spent waiting for the dataloader,
+        and mean time per step of every section in ms.
+        """
+        total = sum(self.sections.values())
+        summary = collections.OrderedDict()
+        summary['samples_per_sec'] = self.num_processes * self.samples / total
+        summary['data_wait_ratio'] = self.sections.get('data_wait', 0) / total
+        summary['step_ms'] = 1000 * total / self.steps
+        for name, value in self.sections.items():
+            summary[name + '_ms'] = 1000 * value / self.steps
+        return summary
+
+
 class Visualizer:
     def __init__(self, kp_size=5, draw_border=False, colormap='gist_rainbow'):
         self.kp_size = kp_size
@@ -189,7 +426,7 @@ class Visualizer:
         ## Occlusion map
         if 'occlusion_map' in out:
             for i in range(len(out['occlusion_map'])):
-                occlusion_map = out['occlusion_map'][i].data.cpu().repeat(1, 3, 1, 1)
+                occlusion_map = out['occlusion_map'][i].data.cpu().float().repeat(1, 3, 1, 1)
                 occlusion_map = F.interpolate(occlusion_map, size=source.shape[1:3]).numpy()
                 occlusion_map = np.transpose(occlusion_map, [0, 2, 3, 1])
                 images.append(occlusion_map)
@@ -2,7 +2,7 @@ from torch import nn
 import torch.nn.functional as F
 import torch
 from modules.util import Hourglass, AntiAliasInterpolation2d, make_coordinate_grid, kp2gaussian
-from modules.util import to_homogeneous, from_homogeneous, UpBlock2d, TPS
+from modules.util import to_homogeneous, from_homogeneous, UpBlock2d, TPS, float32_island
 import math
 
 class DenseMotionNetwork(nn.Module):
@@ -90,12 +90,12 @@ class DenseMotionNetwork(nn.Module):
 
     def create_deformed_source_image(self, source_image, transformations):
 
-        bs, _, h, w = source_image.shape
-        source_repeat = source_image.unsqueeze(1).unsqueeze(1).repeat(1, self.num_tps + 1, 1, 1, 1, 1)
-        source_repeat = source_repeat.view(bs * (self.num_tps + 1), -1, h, w)
-        transformations = transformations.view((bs * (self.num_tps + 1), h, w, -1))
-        deformed = F.grid_sample(source_repeat, transformations, align_corners=True)
-        deformed = deformed.view((bs, self.num_tps+1, -1, h, w))
+        # Fold the K+1 transformations into the height of the sampling grid, so that the
+        # source is sampled once per transformation without being repeated K+1 times.
+        bs, c, h, w = source_image.shape
+        transformations = transformations.reshape(bs, (self.num_tps + 1) * h, w, -1)
+        deformed = F.grid_sample(source_image, transformations, align_corners=True)
+        deformed = deformed.view(bs, c, self.num_tps + 1, h, w).transpose(1, 2)
         return deformed
 
     def dropout_softmax(self, X, P):
@@ -115,37 +115,57 @@ class DenseMotionNetwork(nn.Module):
         partition = X_exp.sum(dim=1, keepdim=True) + 1e-6
         return X_exp / partition  
 
-    def forward(self, source_image, kp_driving, kp_source, bg_param = None, dropout_flag=False, dropout_p = 0):
+    def forward(self, source_image, kp_driving, kp_source, bg_param = None, dropout_flag=False, dropout_p = 0,
+                inference=False):
+        '''
+        With inference=True only 'deformation' and 'occlusion_map' are returned, and the
+        training-only outputs and dropout are skipped.
+        '''
         if self.scale_factor != 1:
             source_image = self.down(source_image)
 
         bs, _, h, w = source_image.shape
 
         out_dict = dict()
-        heatmap_representation = self.create_heatmap_representations(source_image, kp_driving, kp_source)
-        transformations = self.create_transformations(source_image, kp_driving, kp_source, bg_param)
-        deformed_source = self.create_deformed_source_image(source_image, transformations)
-        out_dict['deformed_source'] = deformed_source
+        with float32_island(source_image):
+            source_image = source_image.float()
+            kp_driving = {key: value.float() for key, value in kp_driving.items()}
+            kp_source = {key: value.float() for key, value in kp_source.items()}
+            if bg_param is not None:
+                bg_param = bg_param.float()
+            heatmap_representation = self.create_heatmap_representations(source_image, kp_driving, kp_source)
+            transformations = self.create_transformations(source_image, kp_driving, kp_source, bg_param)
+            deformed_source = self.create_deformed_source_image(source_image, transformations)
+        if not inference:
+            out_dict['deformed_source'] = deformed_source
         # out_dict['transformations'] = transformations
-        deformed_source = deformed_source.view(bs,-1,h,w)
-        input = torch.cat([heatmap_representation, deformed_source], dim=1)
-        input = input.view(bs, -1, h, w)
+        # The hourglass input is allocated once and the transposed deformed sources are copied
+        # straight into it, instead of being made contiguous and then concatenated
+        num_maps = heatmap_representation.shape[1]
+        input = heatmap_representation.new_empty(bs, num_maps + deformed_source.shape[1] * deformed_source.shape[2], h, w)
+        input[:, :num_maps] = heatmap_representation
+        input[:, num_maps:].view(deformed_source.shape).copy_(deformed_source)
 
         prediction = self.hourglass(input, mode = 1)
 
         contribution_maps = self.maps(prediction[-1]) 
-        if(dropout_flag):
-            contribution_maps = self.dropout_softmax(contribution_maps, dropout_p)
-        else:
-            contribution_maps = F.softmax(contribution_maps, dim=1)
-        out_dict['contribution_maps'] = contribution_maps
-
-        # Combine the K+1 transformations
-        # Eq(6) in the paper
-        contribution_maps = contribution_maps.unsqueeze(2)
-        transformations = transformations.permute(0, 1, 4, 2, 3)
-        deformation = (transformations * contribution_maps).sum(dim=1)
-        deformation = deformation.permute(0, 2, 3, 1)
+        with float32_island(contribution_maps):
+            contribution_maps = contribution_maps.float()
+            if(dropout_flag and not inference):
+                contribution_maps = self.dropout_softmax(contribution_maps, dropout_p)
+            else:
+                contribution_maps = F.softmax(contribution_maps, dim=1)
+
+            # Combine the K+1 transformations
+            # Eq(6) in the paper
+            if inference:
+                deformation = torch.einsum('bkhw,bkhwc->bhwc', contribution_maps, transformations)
+            else:
+                out_dict['contribution_maps'] = contribution_maps
+                contribution_maps = contribution_maps.unsqueeze(2)
+                transformations = transformations.permute(0, 1, 4, 2, 3)
+                deformation = (transformations * contribution_maps).sum(dim=1)
+                deformation = deformation.permute(0, 2, 3, 1)
 
         out_dict['deformation'] = deformation # Optical Flow
 
@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d
+from modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, run_block, float32_island
 from modules.dense_motion import DenseMotionNetwork
 
 
@@ -35,15 +35,35 @@ class InpaintingNetwork(nn.Module):
 
         self.final = nn.Conv2d(block_expansion, num_channels, kernel_size=(7, 7), padding=(3, 3))
         self.num_channels = num_channels
+        self.block_expansion = block_expansion
+        self.max_features = max_features
+        # Recompute the activations of the encoder and decoder blocks in backward instead of keeping them
+        self.checkpointing = False
 
-    def deform_input(self, inp, deformation):
+    def resize_deformation(self, deformation, size):
         _, h_old, w_old, _ = deformation.shape
-        _, _, h, w = inp.shape
+        h, w = size
         if h_old != h or w_old != w:
             deformation = deformation.permute(0, 3, 1, 2)
             deformation = F.interpolate(deformation, size=(h, w), mode='bilinear', align_corners=True)
             deformation = deformation.permute(0, 2, 3, 1)
-        return F.grid_sample(inp, deformation,align_corners=True)
+        return deformation
+
+    def deformation_pyramid(self, deformation, feature_maps):
+        """
+        Resize the deformation once for every resolution in feature_maps.
+        """
+        pyramid = {}
+        for feature_map in feature_maps:
+            size = tuple(feature_map.shape[2:])
+            if size not in pyramid:
+                pyramid[size] = self.resize_deformation(deformation, size)
+        return pyramid
+
+    def deform_input(self, inp, deformation):
+        deformation = self.resize_deformation(deformation, inp.shape[2:])
+        with float32_island(inp):
+            return F.grid_sample(inp.float(), deformation.float(), align_corners=True)
 
     def occlude_input(self, inp, occlusion_map):
         if not self.multi_mask:
@@ -52,55 +72,75 @@ class InpaintingNetwork(nn.Module):
         out = inp * occlusion_map
         return out
 
-    def forward(self, source_image, dense_motion):
-        out = self.first(source_image) 
+    def encode(self, source_image):
+        out = run_block(self.first, source_image, self.checkpointing)
         encoder_map = [out]
         for i in range(len(self.down_blocks)):
-            out = self.down_blocks[i](out)
+            out = run_block(self.down_blocks[i], out, self.checkpointing)
             encoder_map.append(out)
+        return encoder_map
+
+    def forward(self, source_image, dense_motion, inference=False, encoder_map=None):
+        '''
+        With inference=True the detached warps used only by the warp loss are skipped and
+        'warped_encoder_maps' is not returned. encoder_map is the output of encode(source_image),
+        if it was already computed.
+        '''
+        if encoder_map is None:
+            encoder_map = self.encode(source_image)
+        out = encoder_map[-1]
 
         output_dict = {}
-        output_dict['contribution_maps'] = dense_motion['contribution_maps']
-        output_dict['deformed_source'] = dense_motion['deformed_source']
+        # Absent when the dense motion network was run with inference=True
+        if 'contribution_maps' in dense_motion:
+            output_dict['contribution_maps'] = dense_motion['contribution_maps']
+        if 'deformed_source' in dense_motion:
+            output_dict['deformed_source'] = dense_motion['deformed_source']
 
         occlusion_map = dense_motion['occlusion_map']
         output_dict['occlusion_map'] = occlusion_map
 
-        deformation = dense_motion['deformation']
-        out_ij = self.deform_input(out.detach(), deformation)
-        out = self.deform_input(out, deformation)
-
-        out_ij = self.occlude_input(out_ij, occlusion_map[0].detach())
-        out = self.occlude_input(out, occlusion_map[0])
+        deformation = self.deformation_pyramid(dense_motion['deformation'], encoder_map)
 
         warped_encoder_maps = []
-        warped_encoder_maps.append(out_ij)
+        if not inference:
+            out_ij = self.deform_input(out.detach(), deformation[tuple(out.shape[2:])])
+            out_ij = self.occlude_input(out_ij, occlusion_map[0].detach())
+            warped_encoder_maps.append(out_ij)
+
+        out = self.deform_input(out, deformation[tuple(out.shape[2:])])
+        out = self.occlude_input(out, occlusion_map[0])
 
         for i in range(self.num_down_blocks):
             
-            out = self.resblock[2*i](out)
-            out = self.resblock[2*i+1](out)
-            out = self.up_blocks[i](out)
+            out = run_block(self.resblock[2*i], out, self.checkpointing)
+            out = run_block(self.resblock[2*i+1], out, self.checkpointing)
+            out = run_block(self.up_blocks[i], out, self.checkpointing)
             
             encode_i = encoder_map[-(i+2)]
-            encode_ij = self.deform_input(encode_i.detach(), deformation)
-            encode_i = self.deform_input(encode_i, deformation)
-            
+            deformation_i = deformation[tuple(encode_i.shape[2:])]
+
             occlusion_ind = 0
             if self.multi_mask:
                 occlusion_ind = i+1
-            encode_ij = self.occlude_input(encode_ij, occlusion_map[occlusion_ind].detach())
+            if not inference:
+                encode_ij = self.deform_input(encode_i.detach(), deformation_i)
+                encode_ij = self.occlude_input(encode_ij, occlusion_map[occlusion_ind].detach())
+                warped_encoder_maps.append(encode_ij)
+
+            encode_i = self.deform_input(encode_i, deformation_i)
             encode_i = self.occlude_input(encode_i, occlusion_map[occlusion_ind])
-            warped_encoder_maps.append(encode_ij)
 
             if(i==self.num_down_blocks-1):
                 break
 
             out = torch.cat([out, encode_i], 1)
 
-        deformed_source = self.deform_input(source_image, deformation)
+        # The source has the resolution of the first encoder map, whose deformation is in the pyramid
+        deformed_source = self.deform_input(source_image, deformation[tuple(source_image.shape[2:])])
         output_dict["deformed"] = deformed_source
-        output_dict["warped_encoder_maps"] = warped_encoder_maps
+        if not inference:
+            output_dict["warped_encoder_maps"] = warped_encoder_maps
 
         occlusion_last = occlusion_map[-1]
         if not self.multi_mask:
@@ -114,6 +154,139 @@ class InpaintingNetwork(nn.Module):
 
         return output_dict
 
+    def tile_size_for_budget(self, memory_budget, image_shape, element_size=4):
+        """
+        Largest tile edge (a multiple of 2**num_down_blocks) whose decoder activations fit into
+        memory_budget bytes next to the full-frame encoder maps. This is a rough estimate that
+        counts about four feature maps per decoder level.
+        """
+        bs, _, h, w = image_shape
+        stride = 2 ** self.num_down_blocks
+        features = [min(self.max_features, self.block_expansion * (2 ** i)) for i in range(self.num_down_blocks + 1)]
+        encoder_bytes = element_size * bs * h * w * sum(f / 4 ** i for i, f in enumerate(features))
+        tile_bytes_per_pixel = element_size * bs * (16 + sum(4 * f / 4 ** i for i, f in enumerate(features)))
+
+        tile_size = 0
+        if memory_budget > encoder_bytes:
+            tile_size = int(((memory_budget - encoder_bytes) / tile_bytes_per_pixel) ** 0.5) // stride * stride
+        return min(max(tile_size, 4 * stride), max(h, w))
+
+    def decode_tile(self, encoder_map, deformations, occlusions, source_image, y, x, tile_h, tile_w):
+        """
+        Decoder for the output region [y:y+tile_h, x:x+tile_w]. encoder_map, deformations and
+        occlusions hold full-frame maps for every level, level 0 being the full resolution.
+        """
+        # The cropped grids still point into the full-frame maps, so they are sampled without resizing
+        def crop(level_map, level, channels_last=False):
+            s = 2 ** level
+            if channels_last:
+                return level_map[:, y // s:(y + tile_h) // s, x // s:(x + tile_w) // s]
+            return level_map[:, :, y // s:(y + tile_h) // s, x // s:(x + tile_w) // s]
+
+        level = self.num_down_blocks
+        out = F.grid_sample(encoder_map[level], crop(deformations[level], level, channels_last=True),
+                            align_corners=True)
+        out = out * crop(occlusions[level], level)
+
+        for i in range(self.num_down_blocks):
+            out = self.resblock[2*i](out)
+            out = self.resblock[2*i+1](out)
+            out = self.up_blocks[i](out)
+
+            level = self.num_down_blocks - i - 1
+            encode_i = F.grid_sample(encoder_map[level], crop(deformations[level], level, channels_last=True),
+                                     align_corners=True)
+            encode_i = encode_i * crop(occlusions[level], level)
+
+            if(i==self.num_down_blocks-1):
+                break
+
+            out = torch.cat([out, encode_i], 1)
+
+        occlusion_last = crop(occlusions[0], 0)
+        deformed_source = F.grid_sample(source_image, crop(deformations[0], 0, channels_last=True), align_corners=True)
+
+        out = out * (1 - occlusion_last) + encode_i
+        out = self.final(out)
+        out = torch.sigmoid(out)
+        out = out * (1 - occlusion_last) + deformed_source * occlusion_last
+        return out, deformed_source
+
+    def blending_window(self, start, length, full, overlap, device):
+        '''
+        Linear ramp over the overlap on the sides of a tile that are not on the frame border.
+        '''
+        window = torch.ones(length, device=device)
+        if overlap == 0:
+            return window
+        ramp = torch.linspace(0, 1, overlap + 2, device=device)[1:-1]
+        if start > 0:
+            window[:overlap] = torch.minimum(window[:overlap], ramp)
+        if start + length < full:
+            window[-overlap:] = torch.minimum(window[-overlap:], ramp.flip(0))
+        return window
+
+    def forward_tiled(self, source_image, dense_motion, tile_size=None, overlap=32, memory_budget=None,
+                      encoder_map=None):
+        '''
+        Inference-only forward pass that runs the decoder over overlapping tiles of the output, so that
+        only one tile of warped maps and decoder activations is alive at a time. The encoder maps of the
+        source, the deformation and the occlusion maps are computed once for the full frame and shared
+        by all tiles; encoder_map can be passed in to reuse the encoding of a fixed source image.
+        The tile size is derived from memory_budget (bytes) when not given. Tiles are blended linearly
+        over the overlap; as instance normalization sees only one tile, the result approximates forward().
+        '''
+        bs, _, h, w = source_image.shape
+        stride = 2 ** self.num_down_blocks
+        if encoder_map is None:
+            encoder_map = self.encode(source_image)
+        if tile_size is None:
+            if memory_budget is None:
+                raise ValueError("Either tile_size or memory_budget should be specified.")
+            tile_size = self.tile_size_for_budget(memory_budget, source_image.shape,
+                                                  element_size=encoder_map[0].element_size())
+        tile_size = max(tile_size // stride * stride, stride)
+        overlap = overlap // stride * stride
+
+        deformations = self.deformation_pyramid(dense_motion['deformation'], encoder_map)
+        deformations = [deformations[tuple(feature_map.shape[2:])] for feature_map in encoder_map]
+        occlusions = []
+        for level, feature_map in enumerate(encoder_map):
+            occlusion = dense_motion['occlusion_map'][self.num_down_blocks - level if self.multi_mask else 0]
+            if occlusion.shape[2:] != feature_map.shape[2:]:
+                occlusion = F.interpolate(occlusion, size=feature_map.shape[2:], mode='bilinear', align_corners=True)
+            occlusions.append(occlusion)
+
+        def tile_starts(full):
+            size = min(tile_size, full)
+            step = max(size - overlap, stride)
+            starts = list(range(0, full - size + 1, step))
+            if starts[-1] != full - size:
+                starts.append(full - size)
+            return starts, size
+
+        ys, tile_h = tile_starts(h)
+        xs, tile_w = tile_starts(w)
+        prediction = torch.zeros_like(source_image)
+        deformed = torch.zeros_like(source_image)
+        weight = torch.zeros(1, 1, h, w, dtype=source_image.dtype, device=source_image.device)
+        for y in ys:
+            window_y = self.blending_window(y, tile_h, h, min(overlap, tile_h), source_image.device)
+            for x in xs:
+                window_x = self.blending_window(x, tile_w, w, min(overlap, tile_w), source_image.device)
+                window = (window_y[:, None] * window_x[None, :]).to(source_image.dtype)
+                out, deformed_tile = self.decode_tile(encoder_map, deformations, occlusions, source_image,
+                                                      y, x, tile_h, tile_w)
+                prediction[:, :, y:y + tile_h, x:x + tile_w] += out * window
+                deformed[:, :, y:y + tile_h, x:x + tile_w] = deformed_tile
+                weight[:, :, y:y + tile_h, x:x + tile_w] += window
+
+        output_dict = {}
+        output_dict['occlusion_map'] = dense_motion['occlusion_map']
+        output_dict['deformed'] = deformed
+        output_dict['prediction'] = prediction / weight
+        return output_dict
+
     def get_encode(self, driver_image, occlusion_map):
         out = self.first(driver_image)
         encoder_map = []
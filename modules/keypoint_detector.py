@@ -19,7 +19,8 @@ class KPDetector(nn.Module):
         
     def forward(self, image):
 
-        fg_kp = self.fg_encoder(image)
+        # The TPS transforms are fitted to these keypoints in float32
+        fg_kp = self.fg_encoder(image).float()
         bs, _, = fg_kp.shape
         fg_kp = torch.sigmoid(fg_kp)
         fg_kp = fg_kp * 2 - 1
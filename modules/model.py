@@ -2,7 +2,7 @@ import torchvision
 from torch import nn
 import torch
 import torch.nn.functional as F
-from modules.util import AntiAliasInterpolation2d, TPS
+from modules.util import AntiAliasInterpolation2d, TPS, run_block
 from torchvision import models
 import numpy as np
 
@@ -38,14 +38,16 @@ class Vgg19(torch.nn.Module):
         if not requires_grad:
             for param in self.parameters():
                 param.requires_grad = False
+        # Recompute the activations of the slices in backward instead of keeping them
+        self.checkpointing = False
 
     def forward(self, X):
         X = (X - self.mean) / self.std
-        h_relu1 = self.slice1(X)
-        h_relu2 = self.slice2(h_relu1)
-        h_relu3 = self.slice3(h_relu2)
-        h_relu4 = self.slice4(h_relu3)
-        h_relu5 = self.slice5(h_relu4)
+        h_relu1 = run_block(self.slice1, X, self.checkpointing)
+        h_relu2 = run_block(self.slice2, h_relu1, self.checkpointing)
+        h_relu3 = run_block(self.slice3, h_relu2, self.checkpointing)
+        h_relu4 = run_block(self.slice4, h_relu3, self.checkpointing)
+        h_relu5 = run_block(self.slice5, h_relu4, self.checkpointing)
         out = [h_relu1, h_relu2, h_relu3, h_relu4, h_relu5]
         return out
 
@@ -61,13 +63,42 @@ class ImagePyramide(torch.nn.Module):
             downs[str(scale).replace('.', '-')] = AntiAliasInterpolation2d(num_channels, scale)
         self.downs = nn.ModuleDict(downs)
 
-    def forward(self, x):
+    def forward(self, x, scales=None):
+        """
+        Downsampled x at every scale of the pyramide, or only at the given scales.
+        """
+        if scales is None:
+            scales = [scale.replace('-', '.') for scale in self.downs]
         out_dict = {}
-        for scale, down_module in self.downs.items():
-            out_dict['prediction_' + str(scale).replace('-', '.')] = down_module(x)
+        for scale in scales:
+            out_dict['prediction_' + str(scale)] = self.downs[str(scale).replace('.', '-')](x)
         return out_dict
 
 
+def scheduled_resolution(train_params, epoch):
+    """
+    Fraction of the frame size trained at in epoch, with the progressive_resolution schedule of train_params.
+    """
+    schedule = train_params.get('progressive_resolution')
+    if not schedule:
+        return 1
+    for milestone, resolution in zip(schedule['epoch_milestones'], schedule['resolutions']):
+        if epoch < milestone:
+            return resolution
+    return 1
+
+
+def split_kp(kp, num_splits):
+    """
+    Split the keypoints of a concatenated batch into num_splits equal parts.
+    """
+    parts = [dict() for _ in range(num_splits)]
+    for key, value in kp.items():
+        for part, chunk in zip(parts, value.chunk(num_splits)):
+            part[key] = chunk
+    return parts
+
+
 def detach_kp(kp):
     return {key: value.detach() for key, value in kp.items()}
 
@@ -91,9 +122,17 @@ class GeneratorFullModel(torch.nn.Module):
         self.train_params = train_params
         self.scales = train_params['scales']
 
-        self.pyramid = ImagePyramide(self.scales, inpainting_network.num_channels)
-        if torch.cuda.is_available():
-            self.pyramid = self.pyramid.cuda()
+        # At a reduced resolution the perceptual loss is computed at the same absolute resolutions
+        # as at the full frame size, leaving out the ones above the reduced frame size
+        resolutions = [1]
+        if train_params.get('progressive_resolution'):
+            resolutions += train_params['progressive_resolution']['resolutions']
+        self.resolution_scales = {resolution: [scale if resolution == 1 else scale / resolution
+                                               for scale in self.scales if scale <= resolution]
+                                  for resolution in resolutions}
+        pyramid_scales = {str(scale): scale for scales in self.resolution_scales.values() for scale in scales}
+
+        self.pyramid = ImagePyramide(list(pyramid_scales.values()), inpainting_network.num_channels)
 
         self.loss_weights = train_params['loss_weights']
         self.dropout_epoch = train_params['dropout_epoch']
@@ -103,13 +142,62 @@ class GeneratorFullModel(torch.nn.Module):
         
         if sum(self.loss_weights['perceptual']) != 0:
             self.vgg = Vgg19()
-            if torch.cuda.is_available():
-                self.vgg = self.vgg.cuda()
+        self.batched_perceptual = train_params.get('batched_perceptual', False)
+        # Run the keypoint detector once over the source, driving and transformed frames
+        self.batched_kp = train_params.get('batched_kp', False)
+        # Telemetry of the training loop, which times the parts of forward if set
+        self.telemetry = None
+
+        checkpointing = train_params.get('checkpointing', {})
+        self.dense_motion_network.hourglass.checkpointing = checkpointing.get('hourglass', False)
+        self.inpainting_network.checkpointing = checkpointing.get('inpainting', False)
+        if sum(self.loss_weights['perceptual']) != 0:
+            self.vgg.checkpointing = checkpointing.get('vgg', False)
+
+    def lap(self, name):
+        if self.telemetry is not None:
+            self.telemetry.lap(name)
 
+    def vgg_pyramid(self, pyramide, scales):
+        """
+        Vgg19 features of the pyramide at every scale. Images of the same shape go through Vgg19 as a single batch.
+        """
+        groups = {}
+        for scale in scales:
+            groups.setdefault(tuple(pyramide['prediction_' + str(scale)].shape), []).append(scale)
+        features = {}
+        for group in groups.values():
+            images = torch.cat([pyramide['prediction_' + str(scale)] for scale in group])
+            group_features = [feature.chunk(len(group)) for feature in self.vgg(images)]
+            for i, scale in enumerate(group):
+                features[scale] = [feature[i] for feature in group_features]
+        return features
+
+    def random_transform(self, driving):
+        """
+        Random TPS transform of the equivariance loss and the driving frames it transforms.
+        """
+        transform_random = TPS(mode = 'random', bs = driving.shape[0], device = driving.device,
+                               **self.train_params['transform_params'])
+        transform_grid = transform_random.transform_frame(driving)
+        transformed_frame = F.grid_sample(driving, transform_grid, padding_mode="reflection",align_corners=True)
+        return transform_random, transformed_frame
 
     def forward(self, x, epoch):
-        kp_source = self.kp_extractor(x['source'])
-        kp_driving = self.kp_extractor(x['driving'])
+        if self.batched_kp:
+            # Keypoints of the source, the driving and the randomly transformed driving frames in a single pass.
+            # The BatchNorm statistics of the keypoint detector are then computed over all three.
+            kp_frames = [x['source'], x['driving']]
+            if self.loss_weights['equivariance_value'] != 0:
+                transform_random, transformed_frame = self.random_transform(x['driving'])
+                kp_frames.append(transformed_frame)
+            kps = split_kp(self.kp_extractor(torch.cat(kp_frames)), len(kp_frames))
+            kp_source, kp_driving = kps[0], kps[1]
+        else:
+            kp_source = self.kp_extractor(x['source'])
+            kp_driving = self.kp_extractor(x['driving'])
+        self.lap('kp')
+
         bg_param = None
         if self.bg_predictor:
             if(epoch>=self.bg_start):
@@ -126,20 +214,31 @@ class GeneratorFullModel(torch.nn.Module):
         dense_motion = self.dense_motion_network(source_image=x['source'], kp_driving=kp_driving,
                                                     kp_source=kp_source, bg_param = bg_param, 
                                                     dropout_flag = dropout_flag, dropout_p = dropout_p)
+        self.lap('dense_motion')
         generated = self.inpainting_network(x['source'], dense_motion)
         generated.update({'kp_source': kp_source, 'kp_driving': kp_driving})
+        self.lap('inpainting')
 
         loss_values = {}
 
-        pyramide_real = self.pyramid(x['driving'])
-        pyramide_generated = self.pyramid(generated['prediction'])
+        scales = self.resolution_scales[scheduled_resolution(self.train_params, epoch)]
+        pyramide_real = self.pyramid(x['driving'], scales)
+        pyramide_generated = self.pyramid(generated['prediction'], scales)
 
         # reconstruction loss
         if sum(self.loss_weights['perceptual']) != 0:
             value_total = 0
-            for scale in self.scales:
-                x_vgg = self.vgg(pyramide_generated['prediction_' + str(scale)])
-                y_vgg = self.vgg(pyramide_real['prediction_' + str(scale)])
+            if self.batched_perceptual:
+                # The real features are targets only, so they are computed without keeping activations
+                x_vggs = self.vgg_pyramid(pyramide_generated, scales)
+                with torch.no_grad():
+                    y_vggs = self.vgg_pyramid(pyramide_real, scales)
+            for scale in scales:
+                if self.batched_perceptual:
+                    x_vgg, y_vgg = x_vggs[scale], y_vggs[scale]
+                else:
+                    x_vgg = self.vgg(pyramide_generated['prediction_' + str(scale)])
+                    y_vgg = self.vgg(pyramide_real['prediction_' + str(scale)])
 
                 for i, weight in enumerate(self.loss_weights['perceptual']):
                     value = torch.abs(x_vgg[i] - y_vgg[i].detach()).mean()
@@ -148,10 +247,11 @@ class GeneratorFullModel(torch.nn.Module):
 
         # equivariance loss
         if self.loss_weights['equivariance_value'] != 0:
-            transform_random = TPS(mode = 'random', bs = x['driving'].shape[0], **self.train_params['transform_params'])
-            transform_grid = transform_random.transform_frame(x['driving'])
-            transformed_frame = F.grid_sample(x['driving'], transform_grid, padding_mode="reflection",align_corners=True)
-            transformed_kp = self.kp_extractor(transformed_frame)
+            if self.batched_kp:
+                transformed_kp = kps[2]
+            else:
+                transform_random, transformed_frame = self.random_transform(x['driving'])
+                transformed_kp = self.kp_extractor(transformed_frame)
 
             generated['transformed_frame'] = transformed_frame
             generated['transformed_kp'] = transformed_kp
@@ -164,7 +264,9 @@ class GeneratorFullModel(torch.nn.Module):
         # warp loss
         if self.loss_weights['warp_loss'] != 0:
             occlusion_map = generated['occlusion_map']
-            encode_map = self.inpainting_network.get_encode(x['driving'], occlusion_map)
+            # The encoder maps of the driving frame are targets only, so no activations are kept for them
+            with torch.no_grad():
+                encode_map = self.inpainting_network.get_encode(x['driving'], occlusion_map)
             decode_map = generated['warped_encoder_maps']
             value = 0
             for i in range(len(encode_map)):
@@ -180,4 +282,5 @@ class GeneratorFullModel(torch.nn.Module):
             value = torch.abs(eye - value).mean()
             loss_values['bg'] = self.loss_weights['bg'] * value
 
+        self.lap('losses')
         return loss_values, generated
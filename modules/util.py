@@ -1,6 +1,24 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def run_block(block, x, checkpointing=False):
+    """
+    block(x), with the activations of block recomputed in backward instead of kept if checkpointing is set.
+    """
+    if checkpointing and torch.is_grad_enabled():
+        return checkpoint(block, x, use_reentrant=False)
+    return block(x)
+
+
+def float32_island(tensor):
+    """
+    Context in which mixed precision autocast is off on the device of tensor. Numerically fragile code
+    (matrix inversion, exponentials, sampling grids) runs in it on float32 inputs.
+    """
+    return torch.autocast(device_type=tensor.device.type, enabled=False)
 
 
 class TPS:
@@ -11,15 +29,18 @@ class TPS:
         self.bs = bs
         self.mode = mode
         if mode == 'random':
-            noise = torch.normal(mean=0, std=kwargs['sigma_affine'] * torch.ones([bs, 2, 3]))
-            self.theta = noise + torch.eye(2, 3).view(1, 2, 3)
+            # Sampled directly on kwargs['device'] if given
+            device = kwargs.get('device')
+            noise = torch.normal(mean=0, std=kwargs['sigma_affine'] * torch.ones([bs, 2, 3], device=device))
+            self.theta = noise + torch.eye(2, 3, device=device).view(1, 2, 3)
             self.control_points = make_coordinate_grid((kwargs['points_tps'], kwargs['points_tps']), type=noise.type())
             self.control_points = self.control_points.unsqueeze(0)
             self.control_params = torch.normal(mean=0, 
-                        std=kwargs['sigma_tps'] * torch.ones([bs, 1, kwargs['points_tps'] ** 2]))
+                        std=kwargs['sigma_tps'] * torch.ones([bs, 1, kwargs['points_tps'] ** 2], device=device))
         elif mode == 'kp':
-            kp_1 = kwargs["kp_1"]
-            kp_2 = kwargs["kp_2"]
+            # The fit inverts a matrix, which is too imprecise in half precision
+            kp_1 = kwargs["kp_1"].float()
+            kp_2 = kwargs["kp_2"].float()
             device = kp_1.device
             kp_type = kp_1.type()
             self.gs = kp_1.shape[1]
@@ -41,7 +62,8 @@ class TPS:
             one = torch.eye(L.shape[2]).expand(L.shape).to(device).type(kp_type)*0.01
             L = L + one
 
-            param = torch.matmul(torch.inverse(L),Y)
+            with float32_island(L):
+                param = torch.matmul(torch.inverse(L),Y)
             self.theta = param[:,:,n:,:].permute(0,1,3,2)
 
             self.control_points = kp_1
@@ -59,6 +81,10 @@ class TPS:
         return grid
 
     def warp_coordinates(self, coordinates):
+        with float32_island(coordinates):
+            return self.warp_coordinates_float32(coordinates.float())
+
+    def warp_coordinates_float32(self, coordinates):
         theta = self.theta.type(coordinates.type()).to(coordinates.device)
         control_points = self.control_points.type(coordinates.type()).to(coordinates.device)
         control_params = self.control_params.type(coordinates.type()).to(coordinates.device)
@@ -232,11 +258,11 @@ class Encoder(nn.Module):
                                            kernel_size=3, padding=1))
         self.down_blocks = nn.ModuleList(down_blocks)
 
-    def forward(self, x):
+    def forward(self, x, checkpointing=False):
         outs = [x]
         #print('encoder:' ,outs[-1].shape)
         for down_block in self.down_blocks:
-            outs.append(down_block(outs[-1]))
+            outs.append(run_block(down_block, outs[-1], checkpointing))
             #print('encoder:' ,outs[-1].shape)
         return outs
 
@@ -261,11 +287,11 @@ class Decoder(nn.Module):
         self.out_channels.append(block_expansion + in_features)
         # self.out_filters = block_expansion + in_features
 
-    def forward(self, x, mode = 0):
+    def forward(self, x, mode = 0, checkpointing=False):
         out = x.pop()
         outs = []
         for up_block in self.up_blocks:
-            out = up_block(out)
+            out = run_block(up_block, out, checkpointing)
             skip = x.pop()
             out = torch.cat([out, skip], dim=1)
             outs.append(out)
@@ -286,9 +312,11 @@ class Hourglass(nn.Module):
         self.decoder = Decoder(block_expansion, in_features, num_blocks, max_features)
         self.out_channels = self.decoder.out_channels
         # self.out_filters = self.decoder.out_filters
+        # Recompute the activations of the blocks in backward instead of keeping them
+        self.checkpointing = False
 
     def forward(self, x, mode = 0):
-        return self.decoder(self.encoder(x), mode)
+        return self.decoder(self.encoder(x, self.checkpointing), mode, self.checkpointing)
 
 
 class AntiAliasInterpolation2d(nn.Module):
@@ -0,0 +1,86 @@
+"""
+Pack a dataset for FramesDataset into memory-mapped shards.
+
+Every video of root_dir (folder of frames, image of concatenated frames, '.mp4', '.gif' or '.mov')
+is decoded once and its frames are appended as uint8 to .npy shards. out_dir/train and out_dir/test
+get their shards and an index.json with the shard, offset, number of frames and id of every video.
+Use out_dir as root_dir in the config to train from the packed dataset.
+"""
+import os
+import json
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+from skimage import img_as_ubyte
+from skimage.transform import resize
+from tqdm import tqdm
+
+from frames_dataset import read_video, list_splits, PACKED_INDEX
+
+
+def load_video(args):
+    path, frame_shape = args
+    try:
+        video = read_video(path, frame_shape=frame_shape)
+        if frame_shape is not None and video.shape[1:] != tuple(frame_shape):
+            # Folders of frames are read at the size of their frames
+            video = np.array([resize(frame, frame_shape) for frame in video])
+        return path, img_as_ubyte(video)
+    except Exception as e:
+        print(e)
+        print("Error reading video: %s" % path)
+        return path, None
+
+
+def pack_split(videos, out_dir, frame_shape, shard_size, workers):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    index = {'shards': [], 'videos': []}
+    shard = []
+    shard_frames = 0
+
+    def write_shard():
+        name = 'shard-%05d.npy' % len(index['shards'])
+        np.save(os.path.join(out_dir, name), np.concatenate(shard))
+        index['shards'].append(name)
+
+    with Pool(workers) as pool:
+        for path, video in tqdm(pool.imap(load_video, [(path, frame_shape) for path in videos]), total=len(videos)):
+            if video is None or len(video) == 0:
+                continue
+            # A shard holds frames of a single shape
+            if shard and (shard[0].shape[1:] != video.shape[1:] or shard_frames * video[0].nbytes >= shard_size):
+                write_shard()
+                shard = []
+                shard_frames = 0
+
+            name = os.path.basename(path)
+            index['videos'].append({'name': name, 'id': name.split('#')[0], 'shard': len(index['shards']),
+                                    'offset': shard_frames, 'num_frames': len(video)})
+            shard.append(video)
+            shard_frames += len(video)
+
+    if shard:
+        write_shard()
+
+    with open(os.path.join(out_dir, PACKED_INDEX), 'w') as f:
+        json.dump(index, f)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--root_dir", required=True, help="dataset to pack, as root_dir in the config")
+    parser.add_argument("--out_dir", required=True, help="path of the packed dataset")
+    parser.add_argument("--frame_shape", default=None, type=lambda x: tuple(map(int, x.split(','))),
+                        help="resize frames to this shape, e.g. 256,256,3, as frame_shape in the config")
+    parser.add_argument("--random_seed", default=0, type=int, help="seed of the split, if root_dir has no train/test")
+    parser.add_argument("--shard_size", default=1024, type=int, help="size of a shard in MB")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="number of decoding processes")
+
+    opt = parser.parse_args()
+
+    for split, videos in list_splits(opt.root_dir, opt.random_seed).items():
+        print("Packing %s: %d videos" % (split, len(videos)))
+        pack_split(videos, os.path.join(opt.out_dir, split), opt.frame_shape, opt.shard_size * 2 ** 20, opt.workers)
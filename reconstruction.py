@@ -5,6 +5,7 @@ from torch.utils.data import DataLoader
 from logger import Logger, Visualizer
 import numpy as np
 import imageio
+from frames_dataset import frames_to_float
 
 
 def reconstruction(config, inpainting_network, kp_detector, bg_predictor, dense_motion_network, checkpoint, log_dir, dataset):
@@ -38,6 +39,7 @@ def reconstruction(config, inpainting_network, kp_detector, bg_predictor, dense_
             visualizations = []
             if torch.cuda.is_available():
                 x['video'] = x['video'].cuda()
+            x['video'] = frames_to_float(x['video'])
             kp_source = kp_detector(x['video'][:, :, 0])
             for frame_idx in range(x['video'].shape[2]):
                 source = x['video'][:, :, 0]
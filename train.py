@@ -1,16 +1,41 @@
 from tqdm import trange
 import torch
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from logger import Logger
-from modules.model import GeneratorFullModel
+from logger import Logger, Telemetry
+from modules.model import GeneratorFullModel, scheduled_resolution
 from torch.optim.lr_scheduler import MultiStepLR
 from torch.nn.utils import clip_grad_norm_
-from frames_dataset import DatasetRepeater
+from frames_dataset import DatasetRepeater, ResumableSampler, collate_pairs, frames_to_float
+from augmentation import BatchAugmentation
 from tqdm import tqdm
+import contextlib
 import math
-from accelerate import Accelerator
+import random
+import time
+import numpy as np
+from accelerate import Accelerator, DistributedDataParallelKwargs
+from cpu_distributed import init_cpu_distributed
+
+# Parts of the models are not used in every step, e.g. bg_predictor before bg_start
+accelerator = Accelerator(cpu=init_cpu_distributed(),
+                          kwargs_handlers=[DistributedDataParallelKwargs(find_unused_parameters=True)])
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
 
-accelerator = Accelerator()
 
 def train(config, inpainting_network, kp_detector, bg_predictor, dense_motion_network, checkpoint, log_dir, dataset,
           optimizer_class=torch.optim.Adam
@@ -36,8 +61,12 @@ def train(config, inpainting_network, kp_detector, bg_predictor, dense_motion_ne
             kp_detector = kp_detector, bg_predictor = bg_predictor,
             optimizer = optimizer, optimizer_bg_predictor = optimizer_bg_predictor)
         print('load success:', start_epoch)
-        start_epoch += 1
+        # A checkpoint saved in the middle of an epoch resumes that epoch, the others start the next one
+        resume = Logger.load_resume_state(checkpoint)
+        if resume is None:
+            start_epoch += 1
     else:
+        resume = None
         start_epoch = 0
 
     scheduler_optimizer = MultiStepLR(optimizer, train_params['epoch_milestones'], gamma=0.1,
@@ -48,64 +77,167 @@ def train(config, inpainting_network, kp_detector, bg_predictor, dense_motion_ne
         scheduler_bg_predictor = MultiStepLR(optimizer_bg_predictor, train_params['epoch_milestones'],
                                               gamma=0.1, last_epoch=start_epoch - 1)
         bg_predictor, optimizer_bg_predictor = accelerator.prepare(bg_predictor, optimizer_bg_predictor)
-
+    if resume is not None:
+        scheduler_optimizer.load_state_dict(resume['scheduler_optimizer'])
+        if bg_predictor and 'scheduler_bg_predictor' in resume:
+            scheduler_bg_predictor.load_state_dict(resume['scheduler_bg_predictor'])
+
+    # Every loaded video yields pairs_per_video pairs, so it is revisited that many times less
+    pairs_per_video = dataset.pairs_per_video
+    frame_cache = dataset.cache
+    # Workers deliver uint8 frames, augmented here once the batch is on the device
+    batch_augmentation = None
+    if dataset.augmentation_on_device:
+        batch_augmentation = BatchAugmentation(**config['dataset_params']['augmentation_params'])
+    # batch_size is split into accumulation_steps batches, whose gradients are summed before every optimizer step
+    accumulation_steps = train_params.get('gradient_accumulation_steps', 1)
+    assert train_params['batch_size'] % (pairs_per_video * accumulation_steps) == 0, \
+        "batch_size should be a multiple of pairs_per_video * gradient_accumulation_steps"
     if 'num_repeats' in train_params or train_params['num_repeats'] != 1:
-        dataset = DatasetRepeater(dataset, train_params['num_repeats'])
-    dataloader = DataLoader(dataset, batch_size=train_params['batch_size'], shuffle=True, 
-                            num_workers=train_params['dataloader_workers'], drop_last=True)
+        dataset = DatasetRepeater(dataset, max(1, train_params['num_repeats'] // pairs_per_video))
+    batch_size = train_params['batch_size'] // (pairs_per_video * accumulation_steps)
+    # The order of the samples only depends on the seed and the epoch, so that an epoch can be resumed
+    sampler = ResumableSampler(dataset, seed=train_params.get('seed', 0))
+    # Workers are kept across epochs, so that the frame counts they gathered (see FramesDataset) are not lost
+    dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                            num_workers=train_params['dataloader_workers'], drop_last=True,
+                            persistent_workers=train_params['dataloader_workers'] > 0,
+                            collate_fn=collate_pairs if pairs_per_video > 1 else None)
 
     generator_full = GeneratorFullModel(kp_detector, bg_predictor, dense_motion_network, inpainting_network, train_params)
+    # Time breakdown of the steps, written to log.txt and telemetry.jsonl after every epoch
+    telemetry = Telemetry(train_params.get('telemetry', False), accelerator.num_processes)
+    if telemetry.enabled:
+        generator_full.telemetry = telemetry
         
     bg_start = train_params['bg_start']
 
+    # The conv stacks run in float16 or bfloat16 under autocast, TPS fitting, sampling grids and
+    # softmax stay in float32 (see float32_island). float16 gradients are loss scaled.
+    precision = train_params.get('mixed_precision', 'no')
+    autocast_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(precision)
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+    if resume is not None and 'scaler' in resume:
+        scaler.load_state_dict(resume['scaler'])
+
     inpainting_network, kp_detector, dense_motion_network, optimizer, scheduler_optimizer, dataloader, generator_full = accelerator.prepare(
         inpainting_network, kp_detector, dense_motion_network, optimizer, scheduler_optimizer, dataloader, generator_full)
 
 
     with Logger(log_dir=log_dir, visualizer_params=config['visualizer_params'], 
-                checkpoint_freq=train_params['checkpoint_freq'],
+                checkpoint_freq=train_params['checkpoint_freq'], log_freq=train_params.get('log_freq', 1),
+                use_wandb=train_params.get('use_wandb', True),
+                keep_checkpoints=train_params.get('keep_checkpoints'), main_process=accelerator.is_main_process,
                 models=[inpainting_network, dense_motion_network, kp_detector]
                 ) as logger:
+        # The state of a partially done epoch is saved every resume_interval minutes
+        resume_interval = train_params.get('resume_interval')
+        last_resume_save = time.time()
+        start_step = 0
+        if resume is not None:
+            start_step = resume['step']
+            logger.step = resume['logger_step']
+            # The resumed epoch has the same sample order. Dataloader workers are seeded from this state when
+            # they start, not where the interrupted run's workers were, so their frame picks and augmentations differ.
+            set_rng_state(resume['rng'])
+
         for epoch in trange(start_epoch, train_params['num_epochs']):
-            for x in tqdm(dataloader):
-                losses_generator, generated = generator_full(x, epoch)
-                loss_values = [val.mean() for val in losses_generator.values()]
-                loss = sum(loss_values)
-
-                accelerator.backward(loss)
-
-                clip_grad_norm_(kp_detector.parameters(), max_norm=10, norm_type = math.inf)
-                clip_grad_norm_(dense_motion_network.parameters(), max_norm=10, norm_type = math.inf)
-                if bg_predictor and epoch>=bg_start:
-                    clip_grad_norm_(bg_predictor.parameters(), max_norm=10, norm_type = math.inf)
-                
-                optimizer.step()
-                optimizer.zero_grad()
-                if bg_predictor and epoch>=bg_start:
-                    optimizer_bg_predictor.step()
-                    optimizer_bg_predictor.zero_grad()
-                
-                losses = {key: value.mean().detach().data.cpu().numpy() for key, value in losses_generator.items()}
+            # Early epochs of a progressive_resolution schedule train on downsampled frames
+            resolution = scheduled_resolution(train_params, epoch)
+            # The samples of the steps already done in a resumed epoch are skipped
+            sampler.set_position(epoch, start_step * batch_size * accelerator.num_processes)
+            num_batches = start_step + len(dataloader)
+            telemetry.start()
+            for it, x in enumerate(tqdm(dataloader), start=start_step):
+                telemetry.lap('data_wait')
+                if batch_augmentation is not None:
+                    x['source'], x['driving'] = batch_augmentation(x['source'], x['driving'])
+                x['source'], x['driving'] = frames_to_float(x['source']), frames_to_float(x['driving'])
+                if resolution != 1:
+                    for key in ['source', 'driving']:
+                        x[key] = F.interpolate(x[key], scale_factor=resolution, mode='bilinear',
+                                               align_corners=False, antialias=True)
+                telemetry.lap('preprocess')
+                optimizer_step = (it + 1) % accumulation_steps == 0 or it + 1 == num_batches
+                # The last group of an epoch can have less than accumulation_steps batches
+                group_start = it - it % accumulation_steps
+                group_size = min(accumulation_steps, num_batches - group_start)
+                # Gradients are only all-reduced between processes on the batch of the optimizer step
+                sync_context = contextlib.nullcontext() if optimizer_step else accelerator.no_sync(generator_full)
+                with sync_context:
+                    with torch.autocast(device_type=accelerator.device.type, dtype=autocast_dtype,
+                                        enabled=autocast_dtype is not None):
+                        losses_generator, generated = generator_full(x, epoch)
+                    loss_values = [val.mean().float() for val in losses_generator.values()]
+                    loss = sum(loss_values)
+
+                    accelerator.backward(scaler.scale(loss / group_size))
+                telemetry.lap('backward')
+
+                if optimizer_step:
+                    scaler.unscale_(optimizer)
+                    if bg_predictor and epoch>=bg_start:
+                        scaler.unscale_(optimizer_bg_predictor)
+                    clip_grad_norm_(kp_detector.parameters(), max_norm=10, norm_type = math.inf)
+                    clip_grad_norm_(dense_motion_network.parameters(), max_norm=10, norm_type = math.inf)
+                    if bg_predictor and epoch>=bg_start:
+                        clip_grad_norm_(bg_predictor.parameters(), max_norm=10, norm_type = math.inf)
+
+                    scaler.step(optimizer)
+                    optimizer.zero_grad()
+                    if bg_predictor and epoch>=bg_start:
+                        scaler.step(optimizer_bg_predictor)
+                        optimizer_bg_predictor.zero_grad()
+                    scaler.update()
+                telemetry.lap('optimizer')
+
+                losses = {key: value.mean().detach().float() for key, value in losses_generator.items()}
                 lrs = {
                     'lr_generator': scheduler_optimizer.get_last_lr()[0],
                     'lr_bg_predictor': scheduler_bg_predictor.get_last_lr()[0] if bg_predictor else 0
                 }
                 logger.log_iter(losses=losses, others=lrs)
 
+                if (resume_interval and optimizer_step and it + 1 < num_batches and accelerator.is_main_process
+                        and time.time() - last_resume_save > 60 * resume_interval):
+                    models = {
+                        'inpainting_network': accelerator.unwrap_model(inpainting_network),
+                        'dense_motion_network': accelerator.unwrap_model(dense_motion_network),
+                        'kp_detector': accelerator.unwrap_model(kp_detector),
+                        'optimizer': optimizer,
+                    }
+                    state = {'epoch': epoch, 'step': it + 1, 'scheduler_optimizer': scheduler_optimizer.state_dict(),
+                             'scaler': scaler.state_dict(), 'rng': get_rng_state()}
+                    if bg_predictor:
+                        models['bg_predictor'] = accelerator.unwrap_model(bg_predictor)
+                        models['optimizer_bg_predictor'] = optimizer_bg_predictor
+                        state['scheduler_bg_predictor'] = scheduler_bg_predictor.state_dict()
+                    logger.save_resume_state(models, state)
+                    last_resume_save = time.time()
+                telemetry.lap('logging')
+                telemetry.end_step(x['source'].shape[0])
+            start_step = 0
+
             scheduler_optimizer.step()
             if bg_predictor:
                 scheduler_bg_predictor.step()
             
+            # Unwrapped, so that checkpoints of distributed runs have the keys of the plain networks
             model_save = {
-                'inpainting_network': inpainting_network,
-                'dense_motion_network': dense_motion_network,
-                'kp_detector': kp_detector,
+                'inpainting_network': accelerator.unwrap_model(inpainting_network),
+                'dense_motion_network': accelerator.unwrap_model(dense_motion_network),
+                'kp_detector': accelerator.unwrap_model(kp_detector),
                 'optimizer': optimizer,
             }
             if bg_predictor and epoch>=bg_start:
-                model_save['bg_predictor'] = bg_predictor
+                model_save['bg_predictor'] = accelerator.unwrap_model(bg_predictor)
                 model_save['optimizer_bg_predictor'] = optimizer_bg_predictor
             
             logger.log_epoch(epoch, model_save, inp=x, out=generated)
+            if telemetry.steps > 0:
+                logger.log_telemetry(epoch, telemetry.summary())
+                telemetry.reset()
+            if frame_cache is not None:
+                logger.log_message("frame cache - " + "; ".join("%s %s" % item for item in frame_cache.stats().items()))
 
 
@@ -3,10 +3,12 @@ import torch
 from torch.utils.data import DataLoader
 from logger import Logger
 from torch.optim.lr_scheduler import MultiStepLR
-from frames_dataset import DatasetRepeater
+from frames_dataset import DatasetRepeater, KeypointsDataset, collate_pairs, frames_to_float, weights_digest
+from augmentation import BatchAugmentation
 from accelerate import Accelerator
+from cpu_distributed import init_cpu_distributed
 
-accelerator = Accelerator()
+accelerator = Accelerator(cpu=init_cpu_distributed())
 
 
 def random_scale(kp_params, scale):
@@ -16,6 +18,17 @@ def random_scale(kp_params, scale):
     return new_kp_params
 
 
+def prepare_frames(x, batch_augmentation=None):
+    """
+    Frames of a FramesDataset batch on the device, augmented and as float.
+    """
+    x['source'], x['driving'] = x['source'].to(accelerator.device), x['driving'].to(accelerator.device)
+    if batch_augmentation is not None:
+        x['source'], x['driving'] = batch_augmentation(x['source'], x['driving'])
+    x['source'], x['driving'] = frames_to_float(x['source']), frames_to_float(x['driving'])
+    return x
+
+
 def train_avd(config, inpainting_network, kp_detector, bg_predictor, dense_motion_network, 
               avd_network, checkpoint, log_dir, dataset, optimizer_class=torch.optim.Adam):
     train_params = config['train_avd_params']
@@ -32,23 +45,54 @@ def train_avd(config, inpainting_network, kp_detector, bg_predictor, dense_motio
 
     scheduler = MultiStepLR(optimizer, train_params['epoch_milestones'], gamma=0.1)
 
+    # Every loaded video yields pairs_per_video pairs, so it is revisited that many times less
+    pairs_per_video = dataset.pairs_per_video
+    # Workers deliver uint8 frames, augmented here once the batch is on the device
+    batch_augmentation = None
+    if dataset.augmentation_on_device:
+        batch_augmentation = BatchAugmentation(**config['dataset_params']['augmentation_params'])
+    assert train_params['batch_size'] % pairs_per_video == 0, "batch_size should be a multiple of pairs_per_video"
+    collate_fn = collate_pairs if pairs_per_video > 1 else None
+
+    # With keypoints_dir the AVD network is trained from keypoints extracted once by extract_keypoints.py,
+    # frames are only loaded for the visualization
+    keypoints_dir = train_params.get('keypoints_dir')
+    visualization_loader = None
+    if keypoints_dir is not None:
+        visualization_loader = DataLoader(dataset, batch_size=6, shuffle=True, collate_fn=collate_fn)
+        dataset = KeypointsDataset(keypoints_dir, id_sampling=config['dataset_params'].get('id_sampling', False),
+                                   pairs_per_video=pairs_per_video)
+        assert dataset.kp_detector_digest == weights_digest(kp_detector), \
+            "The keypoints of %s were extracted with another keypoint detector (from %s), run extract_keypoints.py " \
+            "with %s" % (keypoints_dir, dataset.checkpoint, checkpoint)
+        # As in extract_keypoints.py, so that the visualization does not update its BatchNorm statistics
+        kp_detector.eval()
+
     if 'num_repeats' in train_params or train_params['num_repeats'] != 1:
-        dataset = DatasetRepeater(dataset, train_params['num_repeats'])
+        dataset = DatasetRepeater(dataset, max(1, train_params['num_repeats'] // pairs_per_video))
 
-    dataloader = DataLoader(dataset, batch_size=train_params['batch_size'], shuffle=True,
-                            num_workers=train_params['dataloader_workers'], drop_last=True)
+    dataloader = DataLoader(dataset, batch_size=train_params['batch_size'] // pairs_per_video, shuffle=True,
+                            num_workers=train_params['dataloader_workers'], drop_last=True,
+                            persistent_workers=train_params['dataloader_workers'] > 0, collate_fn=collate_fn)
 
     inpainting_network, kp_detector, dense_motion_network, optimizer, scheduler, dataloader, avd_network = accelerator.prepare(
         inpainting_network, kp_detector, dense_motion_network, optimizer, scheduler, dataloader, avd_network)
 
     with Logger(log_dir=log_dir, visualizer_params=config['visualizer_params'], 
-                checkpoint_freq=train_params['checkpoint_freq']) as logger:
+                checkpoint_freq=train_params['checkpoint_freq'], log_freq=train_params.get('log_freq', 1),
+                use_wandb=train_params.get('use_wandb', True), keep_checkpoints=train_params.get('keep_checkpoints'),
+                main_process=accelerator.is_main_process) as logger:
         for epoch in trange(start_epoch, train_params['num_epochs']):
             avd_network.train()
             for x in tqdm(dataloader):
                 with torch.no_grad():
-                    kp_source = kp_detector(x['source'].cuda())
-                    kp_driving_gt = kp_detector(x['driving'].cuda())
+                    if keypoints_dir is not None:
+                        kp_source = {'fg_kp': x['source'].to(accelerator.device)}
+                        kp_driving_gt = {'fg_kp': x['driving'].to(accelerator.device)}
+                    else:
+                        prepare_frames(x, batch_augmentation)
+                        kp_source = kp_detector(x['source'])
+                        kp_driving_gt = kp_detector(x['driving'])
                     kp_driving_random = random_scale(kp_driving_gt, scale=train_params['random_scale'])
                 rec = avd_network(kp_source, kp_driving_random)
 
@@ -63,14 +107,16 @@ def train_avd(config, inpainting_network, kp_detector, bg_predictor, dense_motio
                 optimizer.step()
                 optimizer.zero_grad()
 
-                losses = {key: value.mean().detach().data.cpu().numpy() for key, value in loss_dict.items()}
+                losses = {key: value.mean().detach() for key, value in loss_dict.items()}
                 logger.log_iter(losses=losses)
 
             # Visualization
             avd_network.eval()
+            if visualization_loader is not None:
+                x = prepare_frames(next(iter(visualization_loader)), batch_augmentation)
             with torch.no_grad():
-                source = x['source'][:6].cuda()
-                driving = torch.cat([x['driving'][[0, 1]].cuda(), source[[2, 3, 2, 1]]], dim=0)
+                source = x['source'][:6].to(accelerator.device)
+                driving = torch.cat([x['driving'][[0, 1]].to(accelerator.device), source[[2, 3, 2, 1]]], dim=0)
                 kp_source = kp_detector(source)
                 kp_driving = kp_detector(driving)
 
@@ -83,15 +129,16 @@ def train_avd(config, inpainting_network, kp_detector, bg_predictor, dense_motio
                 generated.update({'kp_source': kp_source, 'kp_driving': kp_driving})
 
             scheduler.step(epoch)
+            # Unwrapped, so that checkpoints of distributed runs have the keys of the plain networks
             model_save = {
-                'inpainting_network': inpainting_network,
-                'dense_motion_network': dense_motion_network,
-                'kp_detector': kp_detector,
-                'avd_network': avd_network,
+                'inpainting_network': accelerator.unwrap_model(inpainting_network),
+                'dense_motion_network': accelerator.unwrap_model(dense_motion_network),
+                'kp_detector': accelerator.unwrap_model(kp_detector),
+                'avd_network': accelerator.unwrap_model(avd_network),
                 'optimizer_avd': optimizer
             }
             if bg_predictor :
-                model_save['bg_predictor'] = bg_predictor
+                model_save['bg_predictor'] = accelerator.unwrap_model(bg_predictor)
 
             logger.log_epoch(epoch, model_save,
                              inp={'source': source, 'driving': driving},